@@ -0,0 +1,506 @@
+from dataclasses import dataclass
+import collections
+import json
+import math
+import os
+import socket
+import sys
+import time
+from opentrons import protocol_api
+# metadata
+metadata = {
+    'protocolName': 'Multiplexed 10-timepoint Quench Assay',
+    'author': 'Lux <lux011@brandeis.edu>',
+    'description': 'Staggered-start variant of the 10-timepoint quench assay. Several reaction columns are started at planned offsets and their timepoint transfers are interleaved into each other\'s idle gaps, quenching into several Corning 3993 96 well fluorescence microplates.',
+    'apiLevel': '2.12'}
+
+# GLOBAL VARIABLE DEFINITION
+
+QUENCH_SLOTS = [1, 2, 3, 7, 8, 11]  # Deck slots holding quench plates, in fill order
+PLATE_COLS = 12  # Number of columns in a 96-well plate
+IMMERSION = 2.0  # mm below the liquid surface to aspirate at
+TELE_QUEUE = 64  # telemetry records held while the network is busy
+
+# DATACLASS OF SCHEDULE EVENTS
+
+
+@dataclass
+class EvDef:
+    # Dataclass for one robot action on the multiplexed timeline
+    start: float    # planned start, in s from the first substrate addition
+    dur: float      # measured duration of the action, in s
+    kind: str       # 'start' (substrate + mix) or 'sample' (timepoint transfer)
+    rxn: int        # index into rxnCols
+    tp: int = -1    # timepoint index, -1 for 'start'
+
+
+# planMultiplex(nRxn, timePoints, startDur, startLead, sampleDur, sampleLead, guard)
+# Place the start of every reaction at the earliest offset where its substrate
+# addition and all of its timepoint transfers fall into gaps left by the
+# reactions already placed. Reaction time zero is the substrate dispense,
+# startLead seconds into a startDur long start action. Timepoints are due at
+# the aspirate, which happens sampleLead seconds into a sampleDur long transfer. Returns the events sorted
+# by start time, and raises if the result has any two overlapping actions.
+def planMultiplex(nRxn, timePoints, startDur, startLead, sampleDur, sampleLead, guard):
+    placed = []
+
+    # clearance(ev)
+    # Shift in s that moves ev past every placed action it overlaps, 0 when
+    # it overlaps none
+    def clearance(ev):
+        shift = 0.0
+        for other in placed:
+            if ev.start < other.start + other.dur + guard and other.start < ev.start + ev.dur + guard:
+                shift = max(shift, other.start + other.dur + guard - ev.start)
+        return shift
+
+    offset = 0.0
+    for rxn in range(nRxn):
+        while True:
+            t0 = offset + startLead
+            events = [EvDef(offset, startDur, 'start', rxn)]
+            for tp in range(len(timePoints)):
+                events.append(EvDef(t0 + timePoints[tp] - sampleLead,
+                                    sampleDur, 'sample', rxn, tp))
+            shift = max(clearance(ev) for ev in events)
+            if shift <= 0:
+                break
+            # Any smaller shift still overlaps the action that needs this one,
+            # so jumping by it skips no offset that fits
+            offset += shift
+        placed.extend(events)
+        # Reactions are started in column order
+        offset += startDur + guard
+
+    placed.sort(key=lambda ev: ev.start)
+
+    # Proof of the plan: consecutive actions never overlap, so no deadline
+    # has to wait on another one
+    for prev, cur in zip(placed, placed[1:]):
+        if cur.start < prev.start + prev.dur + guard:
+            raise RuntimeError('Multiplex plan collision between reaction %d (%s) and reaction %d (%s) at %.1f s' % (
+                prev.rxn + 1, prev.kind, cur.rxn + 1, cur.kind, cur.start))
+    return placed
+
+
+def run(protocol: protocol_api.ProtocolContext):
+
+    # ----------------  RUN VARAIBLES           ----------------
+
+    # Reaction columns on the nunc plate in slot 6, started in this order.
+    # Each reaction uses len(timePoints) quench columns, and the 6 quench
+    # plates hold 72 columns: e.g. 7 reactions x 10 timepoints, or all 12
+    # columns x 6 timepoints
+    rxnCols = [1, 2, 3, 4, 5, 6, 7]
+
+    # Timepoints 1-10: 1,2,3,4,5,7,10,15,20,30 min after substrate is added
+    timePoints = [60, 120, 180, 240, 300, 420, 600, 900, 1200, 1800]
+
+    # Durations in s of the actions below, the longest the timing model of
+    # simulation/timing.py gives with ot2_fitted.json. Replace them with
+    # times measured on the robot when there are some
+    startDuration = 48.5    # pick up tips, add 30uL substrate, mix 5x150uL, blow out, return tips
+    startLead = 15.5        # from start of a start action until its substrate dispense
+    sampleDuration = 25.5   # pick up tips, 25uL into quench plate, blow out, return tips
+    sampleLead = 11.5       # from start of a sample transfer until its aspirate
+    guardTime = 2.0         # minimum idle time kept between two actions
+
+    # Well layout, same for every reaction column (row A-H)
+    rxnLayout = ['E+ S+ rep1', 'E+ S+ rep2', 'E+ S+ rep3', 'E+ S- rep1',
+                 'E+ S- rep2', 'E- S+ rep1', 'E- S+ rep2', 'E- S- rep1']
+
+    # Starting volumes in uL, for liquid level tracking
+    rBufVol = 14000     # slot 4 A1, 15mL tube
+    qBufVol = 14500     # slot 4 A2, 15mL tube
+    lysateVol = 2000    # slot 4 B1, 15mL tube
+    lysBufVol = 1000    # slot 4 C1, 15mL tube
+    subVol = 200        # each substrate well in slot 5
+
+    # Telemetry collector: set to the (IP, UDP port) of the computer running
+    # simulation/telemetry.py, e.g. ('192.168.1.20', 9870). None sends nothing
+    telemetryTarget = None
+
+    # ----------------  END OF RUN VARAIBLES    ----------------
+    # ----------------  EQUIPMENT AND LABWARES  ----------------
+
+    # Labware list on deck
+    #   10      11      Trash   BACK
+    #   7       8       9
+    #   4       5       6
+    #   1       2       3       FRONT
+    #
+    #   Quench plates: 1, 2, 3, 7, 8, 11
+
+    # ----------------  LABWARE INITIALIZATION  ----------------
+
+    # Readability names for labwares
+    # OPENTRONS:
+
+    # tipR_20
+    tipR_300_1: protocol_api.labware.Labware = protocol.load_labware(
+        'opentrons_96_tiprack_300ul', 9)
+    tipR_300_2: protocol_api.labware.Labware = protocol.load_labware(
+        'opentrons_96_tiprack_300ul', 10)
+
+    # tubeR_24xEpp
+    tubeR_6x15_4x50: protocol_api.labware.Labware = protocol.load_labware(
+        'opentrons_10_tuberack_falcon_4x50ml_6x15ml_conical', 4)
+
+    # CORNING:
+    nTP = len(timePoints)
+    nQuenchCols = len(rxnCols) * nTP
+    if nQuenchCols > len(QUENCH_SLOTS) * PLATE_COLS:
+        raise ValueError('%d reactions x %d timepoints need %d quench columns, only %d fit on deck' % (
+            len(rxnCols), nTP, nQuenchCols, len(QUENCH_SLOTS) * PLATE_COLS))
+    quenchPlates = []
+    for i in range(-(-nQuenchCols // PLATE_COLS)):
+        quenchPlates.append(protocol.load_labware(
+            'corning_96_wellplate_190ul', QUENCH_SLOTS[i]))
+
+    # THERMO SCI NUNC
+    nuncP96_1mL: protocol_api.labware.Labware = protocol.load_labware(
+        'thermoscientificnunc_96_wellplate_1300ul', 6)
+    nuncP96_sub: protocol_api.labware.Labware = protocol.load_labware(
+        'thermoscientificnunc_96_wellplate_1300ul', 5)
+
+    # ----------------  BUFFER SETUP            ----------------
+
+    rBuf = tubeR_6x15_4x50.wells_by_name()['A1']
+    qBuf = tubeR_6x15_4x50.wells_by_name()['A2']
+    lysate = tubeR_6x15_4x50.wells_by_name()['B1']
+    lysBuf = tubeR_6x15_4x50.wells_by_name()['C1']
+
+    # ----------------  END OF BUFFER SETUP     ----------------
+    # ----------------  RXN WELL SETUP          ----------------
+
+    # Reaction column i is started with substrate from the same column of slot 5
+    rxnColumns = [nuncP96_1mL.columns()[c - 1] for c in rxnCols]
+    substrateColumns = [nuncP96_sub.columns()[c - 1] for c in rxnCols]
+
+    # Quench column of reaction i at timepoint tp
+    quenchColumns = []
+    for i in range(nQuenchCols):
+        quenchColumns.append(
+            quenchPlates[i // PLATE_COLS].columns()[i % PLATE_COLS])
+
+    # ----------------  END OF RXN WELL SETUP   ----------------
+    # ----------------  END OF LABWARE INIT.    ----------------
+    # ----------------  PIPETTE INITIALIZATION  ----------------
+
+    # Load Pipettes
+    p300s = protocol.load_instrument(
+        'p300_single_gen2', 'left', [tipR_300_2])
+
+    p300m = protocol.load_instrument(
+        'p300_multi_gen2', 'right', [tipR_300_1])
+
+    # Initialize flow rate (faster than default)
+    p300s.flow_rate.aspirate = 50
+    p300s.flow_rate.dispense = 100
+
+    p300m.flow_rate.aspirate = 100
+    p300m.flow_rate.dispense = 100
+
+    # ----------------  END OF PIPETTE INIT.    ----------------
+    # ----------------  END OF EQUIPMENT AND LABWARES   --------
+    # ----------------  LIQUID LEVEL TRACKING   ----------------
+
+    # Per-well volume ledger in uL, seeded from the starting volumes above
+    # and updated on every aspirate and dispense below
+    wellVol = {}
+    underflow = set()   # wells whose ledger ran below zero, warned once
+
+    # wellArea(well)
+    # Cross-section of well in mm^2. Tubes count as a cylinder of their top
+    # diameter, which puts the computed level at or below the real one in a
+    # conical bottom, so the tip never ends up above the liquid
+    def wellArea(well):
+        if well.diameter:
+            return math.pi * (well.diameter / 2) ** 2
+        return well.length * well.width
+
+    # wellShare(well, p)
+    # Number of channels of p drawing from or into well: all of them for a
+    # single-row reservoir, one per well otherwise
+    def wellShare(well, p):
+        if p is not None and len(well.parent.rows()) == 1:
+            return p.channels
+        return 1
+
+    # addVol(well, vol, p)
+    # Book vol uL per channel of p into well, negative vol for out of well.
+    # A well drawn below zero is reported once in the run log, the volumes
+    # the protocol moves are left as they are
+    def addVol(well, vol, p=None):
+        key = str(well)
+        wellVol[key] = wellVol.get(key, 0.0) + vol * wellShare(well, p)
+        if wellVol[key] < 0 and key not in underflow:
+            underflow.add(key)
+            protocol.comment('WARNING: volume ledger of %s is below zero (%.0f uL), '
+                             'check its starting volume and the volumes drawn from it' % (key, wellVol[key]))
+
+    # levelAsp(well, vol, minZ, p)
+    # Location to aspirate vol uL per channel of p from well: IMMERSION mm
+    # below the level left afterwards, no lower than minZ above the bottom.
+    # Wells without a ledger entry keep the fixed minZ height
+    def levelAsp(well, vol, minZ=1.0, p=None):
+        key = str(well)
+        if key not in wellVol:
+            return well.bottom(minZ)
+        left = wellVol[key] - vol * wellShare(well, p)
+        z = min(left / wellArea(well) - IMMERSION, well.depth - IMMERSION)
+        return well.bottom(max(minZ, z))
+
+    # Seed the ledger
+    for well, vol in [(rBuf, rBufVol), (qBuf, qBufVol), (lysate, lysateVol), (lysBuf, lysBufVol)]:
+        addVol(well, vol)
+    for subCol in substrateColumns:
+        addVol(subCol[0], subVol)
+
+    # ----------------  END OF LIQUID LEVEL TRACKING   --------
+    # ----------------  TELEMETRY               ----------------
+
+    # Live run telemetry: one small JSON datagram per step to the collector
+    # in simulation/telemetry.py. Sends never block; when the network can't
+    # keep up, the oldest queued records are dropped instead. The robot runs
+    # single-file protocols, so this block is inlined on purpose; the
+    # canonical copy is in 10TP-Quench-C3993.py and simulation/inlined.py
+    # reports copies that drifted from it
+    teleRacks = [lw for lw in protocol.loaded_labwares.values() if lw.is_tiprack]
+    teleSock = None
+    teleUnsub = None
+    teleQueue = collections.deque(maxlen=TELE_QUEUE)
+    teleState = {'start': time.monotonic(), 'steps': 0, 'cmds': 0}
+
+    # Count robot commands for commands per minute, where the API allows it
+    def teleCount(message):
+        if message.get('$') == 'before':
+            teleState['cmds'] += 1
+
+    if telemetryTarget and not protocol.is_simulating():
+        teleSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        teleSock.setblocking(False)
+        try:
+            teleUnsub = protocol.broker.subscribe('command', teleCount)
+        except AttributeError:
+            pass
+
+    # tele(step, lag)
+    # Queue a record of the current step, with the lag in s of a timepoint
+    # against its schedule, and send whatever the socket takes right now
+    def tele(step, lag=None):
+        if teleSock is None:
+            return
+        teleState['steps'] += 1
+        minutes = max((time.monotonic() - teleState['start']) / 60, 1e-6)
+        teleQueue.append(json.dumps({
+            'robot': socket.gethostname(),
+            'protocol': metadata['protocolName'],
+            'step': step,
+            'lag': lag,
+            'tips': sum(1 for rack in teleRacks for w in rack.wells() if not w.has_tip),
+            'cpm': (teleState['cmds'] or teleState['steps']) / minutes,
+            't': time.time()}).encode())
+        while teleQueue:
+            try:
+                teleSock.sendto(teleQueue[0], telemetryTarget)
+            except OSError:
+                break
+            teleQueue.popleft()
+
+    # teleClose()
+    # Stop counting commands and close the socket at the end of the run
+    def teleClose():
+        if teleUnsub is not None:
+            teleUnsub()
+        if teleSock is not None:
+            teleSock.close()
+
+    # ----------------  END OF TELEMETRY        ----------------
+    # ----------------  TIMING CHECK            ----------------
+
+    # In simulation, simulation/timing.py records the run and fails it at the
+    # end when a timepoint can't be met; modelClock() is its estimate of the
+    # time so far. Inlined on purpose in every protocol with timepoints, the
+    # check itself lives in timing.watchRun(). Skipped where the simulation
+    # folder is not around, like on the robot
+    endTimingCheck = None
+    modelClock = None
+    if protocol.is_simulating():
+        simDir = os.path.join(os.path.dirname(os.path.abspath(
+            sys._getframe().f_code.co_filename)), 'simulation')
+        sys.path.insert(0, simDir)
+        try:
+            from timing import watchRun
+            endTimingCheck, modelClock = watchRun(protocol)
+        except ImportError:
+            protocol.comment('simulation/timing.py not found, timepoint schedule not checked')
+        finally:
+            sys.path.remove(simDir)
+
+    # ----------------  END OF TIMING CHECK     ----------------
+    # ----------------  PLANNING                ----------------
+
+    # Fails here, before anything moves, if the timeline does not fit
+    plan = planMultiplex(len(rxnCols), timePoints, startDuration, startLead,
+                         sampleDuration, sampleLead, guardTime)
+    for ev in plan:
+        if ev.kind == 'start':
+            protocol.comment('Plan: start rxn col %d at %.0f s' %
+                             (rxnCols[ev.rxn], ev.start))
+    protocol.comment('Plan: %d reactions done after %.0f s' % (
+        len(rxnCols), plan[-1].start + plan[-1].dur))
+
+    # ----------------  END OF PLANNING         ----------------
+    # ----------------  START OF PROGRAM        ----------------
+
+    protocol.pause('Please confirm deck setup. Resume to start sequence.')
+    tele('deck confirmed')
+
+    # Fill every used quench column w/ 25uL ea. quenching buffer, blow out last 10uL back into tube
+    p300s.pick_up_tip()
+    for col in range(nQuenchCols):
+        tele('quench fill col %d' % (col + 1))
+        # Aspirate each column
+        p300s.aspirate(210, levelAsp(qBuf, 210), 0.5)
+        addVol(qBuf, -210)
+        for row in range(8):
+            # Pipette each row of column A-H 25uL
+            p300s.dispense(25, quenchColumns[col][row])
+            addVol(quenchColumns[col][row], 25)
+        # Blow out rest in tip
+        p300s.blow_out(qBuf)
+        addVol(qBuf, 210 - 8 * 25)
+    p300s.drop_tip()
+
+    # Prepare 8x 30uL lysate/lysis buffer + 240uL rxn buffer reaction mix w/o substrate
+    # in every reaction column
+
+    # Lysate first
+    tele('lysate')
+    lastE = '0'
+    p300s.pick_up_tip()
+    for rxnCol in rxnColumns:
+        for row in range(8):
+            # Pipette each row A-H 30uL according to E+ or E- in well desc
+            if 'E+' in rxnLayout[row]:
+                if lastE in 'E-':
+                    # Change tip upon content switch
+                    p300s.drop_tip()
+                    p300s.pick_up_tip()
+                p300s.transfer(30, levelAsp(lysate, 30), rxnCol[row], new_tip='never')
+                addVol(lysate, -30)
+                addVol(rxnCol[row], 30)
+                lastE = 'E+'
+            else:
+                if lastE in 'E+':
+                    # Change tip upon content switch
+                    p300s.drop_tip()
+                    p300s.pick_up_tip()
+                p300s.transfer(30, levelAsp(lysBuf, 30), rxnCol[row], new_tip='never')
+                addVol(lysBuf, -30)
+                addVol(rxnCol[row], 30)
+                lastE = 'E-'
+    p300s.drop_tip()
+
+    # Rxn buffer acidification of lysate
+    tele('rxn buffer')
+    # Pipette 240uL of reaction buffer in each reaction well
+    # One transfer per reaction column, so every column aspirates at its own level
+    p300s.pick_up_tip()
+    for rxnCol in rxnColumns:
+        p300s.transfer(240, levelAsp(rBuf, 240 * len(rxnCol)), rxnCol,
+                       new_tip='never')
+        addVol(rBuf, -240 * len(rxnCol))
+        for well in rxnCol:
+            addVol(well, 240)
+    p300s.drop_tip()
+
+    # Pause before starting rxn
+    protocol.pause(
+        'Check if mixtures and plates are ready. Resuming will start the multiplexed timeline.')
+
+    # Every reaction keeps its own column of tips in slot 9 for the whole run,
+    # so tips are returned between actions and samples are dispensed from above
+    # the quench buffer to keep it off the tips
+    rxnTips = [tipR_300_1.columns()[i][0] for i in range(len(rxnCols))]
+
+    # Timeline clock: robot time when running, the modelled time of
+    # simulation/timing.py when simulating, planned time when simulating
+    # without it. The pause above holds the robot only at its next hardware
+    # command, so the clock starts at the first substrate dispense of the
+    # timeline, reaction time zero of the first reaction, not here
+    tick = modelClock if protocol.is_simulating() else time.monotonic
+    clock0 = [None]
+    simClock = [0.0]
+
+    def now():
+        if tick is None:
+            return simClock[0]
+        if clock0[0] is None:
+            return 0.0
+        return tick() - clock0[0]
+
+    maxLate = 0.0
+    for ev in plan:
+        # Wait for the planned start of the next action
+        wait = ev.start - now()
+        if wait > 0:
+            protocol.delay(wait)
+        late = now() - ev.start
+        maxLate = max(maxLate, late)
+        if late > guardTime:
+            protocol.comment('WARNING: rxn col %d %s %d started %.1f s late' % (
+                rxnCols[ev.rxn], ev.kind, ev.tp + 1, late))
+
+        if ev.kind == 'sample':
+            # Timepoint marker for the timing checker in simulation/timing.py
+            protocol.comment('@tp rxn%d %d %.1f' % (
+                rxnCols[ev.rxn], ev.tp + 1, timePoints[ev.tp]))
+        p300m.pick_up_tip(rxnTips[ev.rxn])
+        if ev.kind == 'start':
+            # Add substrate
+            p300m.aspirate(30, levelAsp(substrateColumns[ev.rxn][0], 30))
+            addVol(substrateColumns[ev.rxn][0], -30)
+            p300m.dispense(30, rxnColumns[ev.rxn][0])
+            if clock0[0] is None and tick is not None:
+                clock0[0] = tick() - ev.start - startLead
+            addVol(rxnColumns[ev.rxn][0], 30)
+            # Reaction time zero is the substrate dispense, for the timing
+            # checker in simulation/timing.py
+            protocol.comment('@t0 rxn%d' % rxnCols[ev.rxn])
+            tele('start rxn col %d' % rxnCols[ev.rxn])
+            p300m.mix(5, 150)
+            # Blow out at top of well
+            p300m.blow_out(rxnColumns[ev.rxn][0].top())
+        else:
+            # Transfer timepoint to its quench column
+            p300m.aspirate(25, levelAsp(rxnColumns[ev.rxn][0], 25))
+            # lag of the sample against its plan, taken as it leaves the rxn well
+            lag = now() - (ev.start + sampleLead)
+            addVol(rxnColumns[ev.rxn][0], -25)
+            dest = quenchColumns[ev.rxn * nTP + ev.tp][0]
+            p300m.dispense(25, dest.top(-2))
+            addVol(dest, 25)
+            p300m.blow_out(dest.top(-2))
+            tele('rxn col %d tp %d' % (rxnCols[ev.rxn], ev.tp + 1), lag)
+        if ev.kind == 'sample' and ev.tp == nTP - 1:
+            # Last timepoint of this reaction
+            p300m.drop_tip()
+        else:
+            p300m.return_tip()
+        simClock[0] = ev.start + ev.dur
+
+    protocol.comment('Latest action started %.1f s after plan' % maxLate)
+
+    # Finalizing cleanup
+    if p300m.has_tip:
+        p300m.drop_tip()
+    if p300s.has_tip:
+        p300s.drop_tip()
+    tele('complete')
+    teleClose()
+    # Fails the simulation here if a timepoint can't be met
+    if endTimingCheck is not None:
+        endTimingCheck()
+    protocol.pause('Sequence complete.')
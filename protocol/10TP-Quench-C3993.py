@@ -1,7 +1,15 @@
 from dataclasses import dataclass
+import collections
+import json
+import math
+import os
+import socket
+import sys
+import time
 from multiprocessing.sharedctypes import Value
 from opentrons import protocol_api
 import opentrons
+from opentrons.types import Location
 # metadata
 metadata = {
     'protocolName': '10-timepoint Quenching Assay',
@@ -9,8 +17,52 @@ metadata = {
     'description': 'Prototype protocol to prepare, start, taketimepoints and quench into a Corning 3993 96 well fluorescence microplate. Adapted from JYChow@NUS',
     'apiLevel': '2.12'}
 
+# GLOBAL VARIABLE DEFINITION
+
+IMMERSION = 2.0  # mm below the liquid surface to aspirate at
+TELE_QUEUE = 64  # telemetry records held while the network is busy
+C3993_WELL = 190.0  # uL, well capacity of the 96-well quench plate
+HOP_MARGIN = 10.0  # mm above the tallest labware under a hop
+HOP_STEP = 10.0  # mm between checks of a swept slot footprint
+SLOT_SIZE = (127.76, 85.48)  # mm, OT-2 deck slot footprint
+
 
 def run(protocol: protocol_api.ProtocolContext):
+
+    # ----------------  RUN VARAIBLES           ----------------
+
+    # Starting volumes in uL, for liquid level tracking
+    rBufVol = 10000     # slot 4 A1, 15mL tube
+    qBufVol = 10000     # slot 4 A2, 15mL tube
+    lysateVol = 1000    # slot 4 B1, 15mL tube
+    lysBufVol = 1000    # slot 4 C1, 15mL tube
+    subVol = 200        # each substrate well
+
+    # Quench plate format: 96 (Corning 3993) or 384 (Corning 384 flat). In
+    # 384 format a run fills one quadrant (0: A1, 1: B1, 2: A2, 3: B2), so
+    # four runs share one plate
+    quenchFormat = 96
+    quadrant = 0
+    qBufWell = 25       # uL quench buffer per well, 96 format
+    sampleVol = 25      # uL sample per timepoint well, 96 format
+
+    # Telemetry collector: set to the (IP, UDP port) of the computer running
+    # simulation/telemetry.py, e.g. ('192.168.1.20', 9870). None sends nothing
+    telemetryTarget = None
+
+    # First fresh tip in the rack of each mount, for racks reused between runs
+    startTips = {'left': 'A1', 'right': 'A1'}
+
+    # Tip pick-ups of each mount from one idle window to the next, copied
+    # from the output of simulation/tipsched.py for this protocol. Regenerate
+    # them whenever the plan changes; tipsched.py --check reports stale ones
+    tipWindows = ['deck', 'mixture']
+    tipDemand = {
+        'deck': {'left': 4},
+        'mixture': {'right': 11},
+    }
+
+    # ----------------  END OF RUN VARAIBLES    ----------------
     # ----------------  EQUIPMENT AND LABWARES  ----------------
 
     # Labware list on deck
@@ -46,8 +98,12 @@ def run(protocol: protocol_api.ProtocolContext):
     # aluB_flat
 
     # CORNING:
-    microP96_C3993: protocol_api.labware.Labware = protocol.load_labware(
-        'corning_96_wellplate_190ul', 1)
+    if quenchFormat == 384:
+        quenchP: protocol_api.labware.Labware = protocol.load_labware(
+            'corning_384_wellplate_112ul_flat', 1)
+    else:
+        quenchP: protocol_api.labware.Labware = protocol.load_labware(
+            'corning_96_wellplate_190ul', 1)
 
     # THERMO SCI NUNC
     nuncP96_1mL: protocol_api.labware.Labware = protocol.load_labware(
@@ -84,6 +140,18 @@ def run(protocol: protocol_api.ProtocolContext):
         (nuncP96_1mL, nuncP96_1mL.columns()[1][6], 'G2 10uM Sub'),
         (nuncP96_1mL, nuncP96_1mL.columns()[1][7], 'H2 10% DMSO')
     ]
+    # quenchWells(tp)
+    # Quench wells of timepoint tp, one per reaction row A-H. On the 384-well
+    # plate they are every other row of one column of the run's quadrant,
+    # the wells the multichannel reaches at once
+    def quenchWells(tp):
+        if quenchFormat == 384:
+            return quenchP.columns()[2 * tp + quadrant // 2][quadrant % 2::2]
+        return quenchP.columns()[tp]
+
+    if quenchFormat == 384 and quadrant not in range(4):
+        raise RuntimeError('quadrant must be 0-3, not %r' % quadrant)
+
     # ----------------  END OF RXN WELL SETUP   ----------------
     # ----------------  END OF LABWARE INIT.    ----------------
     # ----------------  PIPETTE INITIALIZATION  ----------------
@@ -95,6 +163,10 @@ def run(protocol: protocol_api.ProtocolContext):
     p300m = protocol.load_instrument(
         'p300_multi_gen2', 'right', [tipR_300_1])
 
+    # Continue partly used racks
+    p300s.starting_tip = tipR_300_2.wells_by_name()[startTips['left']]
+    p300m.starting_tip = tipR_300_1.wells_by_name()[startTips['right']]
+
     # Initialize flow rate (faster than default)
     p300s.flow_rate.aspirate = 50
     p300s.flow_rate.dispense = 100
@@ -102,27 +174,309 @@ def run(protocol: protocol_api.ProtocolContext):
     p300m.flow_rate.aspirate = 100
     p300m.flow_rate.dispense = 100
 
+    # Scale the quench well volumes to the well capacity of the quench plate.
+    # Where that takes a volume below what its pipette takes, both are scaled
+    # up together so the quench buffer to sample ratio stays the same
+    volScale = quenchP.wells()[0].max_volume / C3993_WELL
+    minScale = max(p300s.min_volume / qBufWell, p300m.min_volume / sampleVol)
+    if volScale < minScale:
+        protocol.comment('WARNING: %.1f uL quench buffer + %.1f uL sample per well is below the '
+                         'pipette minimum, using %.1f + %.1f uL instead' % (
+                             qBufWell * volScale, sampleVol * volScale,
+                             qBufWell * minScale, sampleVol * minScale))
+        volScale = minScale
+    if (qBufWell + sampleVol) * volScale > quenchP.wells()[0].max_volume:
+        raise RuntimeError('%.1f uL quench buffer + %.1f uL sample overflow the %.0f uL quench wells' % (
+            qBufWell * volScale, sampleVol * volScale, quenchP.wells()[0].max_volume))
+    qBufWell = round(qBufWell * volScale * 2) / 2
+    sampleVol = round(sampleVol * volScale * 2) / 2
+    fillVol = 8 * qBufWell + 10
+
     # ----------------  END OF PIPETTE INIT.    ----------------
     # ----------------  END OF EQUIPMENT AND LABWARES   --------
+    # ----------------  LIQUID LEVEL TRACKING   ----------------
+
+    # Per-well volume ledger in uL, seeded from the starting volumes above
+    # and updated on every aspirate and dispense below
+    wellVol = {}
+    underflow = set()   # wells whose ledger ran below zero, warned once
+
+    # wellArea(well)
+    # Cross-section of well in mm^2. Tubes count as a cylinder of their top
+    # diameter, which puts the computed level at or below the real one in a
+    # conical bottom, so the tip never ends up above the liquid
+    def wellArea(well):
+        if well.diameter:
+            return math.pi * (well.diameter / 2) ** 2
+        return well.length * well.width
+
+    # wellShare(well, p)
+    # Number of channels of p drawing from or into well: all of them for a
+    # single-row reservoir, one per well otherwise
+    def wellShare(well, p):
+        if p is not None and len(well.parent.rows()) == 1:
+            return p.channels
+        return 1
+
+    # addVol(well, vol, p)
+    # Book vol uL per channel of p into well, negative vol for out of well.
+    # A well drawn below zero is reported once in the run log, the volumes
+    # the protocol moves are left as they are
+    def addVol(well, vol, p=None):
+        key = str(well)
+        wellVol[key] = wellVol.get(key, 0.0) + vol * wellShare(well, p)
+        if wellVol[key] < 0 and key not in underflow:
+            underflow.add(key)
+            protocol.comment('WARNING: volume ledger of %s is below zero (%.0f uL), '
+                             'check its starting volume and the volumes drawn from it' % (key, wellVol[key]))
+
+    # levelAsp(well, vol, minZ, p)
+    # Location to aspirate vol uL per channel of p from well: IMMERSION mm
+    # below the level left afterwards, no lower than minZ above the bottom.
+    # Wells without a ledger entry keep the fixed minZ height
+    def levelAsp(well, vol, minZ=1.0, p=None):
+        key = str(well)
+        if key not in wellVol:
+            return well.bottom(minZ)
+        left = wellVol[key] - vol * wellShare(well, p)
+        z = min(left / wellArea(well) - IMMERSION, well.depth - IMMERSION)
+        return well.bottom(max(minZ, z))
+
+    # Seed the ledger
+    for well, vol in [(rBuf, rBufVol), (qBuf, qBufVol), (lysate, lysateVol), (lysBuf, lysBufVol)]:
+        addVol(well, vol)
+    for sub in substrateWells:
+        addVol(sub[1], subVol)
+
+    # ----------------  END OF LIQUID LEVEL TRACKING   --------
+    # ----------------  TELEMETRY               ----------------
+
+    # Live run telemetry: one small JSON datagram per step to the collector
+    # in simulation/telemetry.py. Sends never block; when the network can't
+    # keep up, the oldest queued records are dropped instead. The robot runs
+    # single-file protocols, so this block is inlined on purpose; the
+    # canonical copy is in 10TP-Quench-C3993.py and simulation/inlined.py
+    # reports copies that drifted from it
+    teleRacks = [lw for lw in protocol.loaded_labwares.values() if lw.is_tiprack]
+    teleSock = None
+    teleUnsub = None
+    teleQueue = collections.deque(maxlen=TELE_QUEUE)
+    teleState = {'start': time.monotonic(), 'steps': 0, 'cmds': 0}
+
+    # Count robot commands for commands per minute, where the API allows it
+    def teleCount(message):
+        if message.get('$') == 'before':
+            teleState['cmds'] += 1
+
+    if telemetryTarget and not protocol.is_simulating():
+        teleSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        teleSock.setblocking(False)
+        try:
+            teleUnsub = protocol.broker.subscribe('command', teleCount)
+        except AttributeError:
+            pass
+
+    # tele(step, lag)
+    # Queue a record of the current step, with the lag in s of a timepoint
+    # against its schedule, and send whatever the socket takes right now
+    def tele(step, lag=None):
+        if teleSock is None:
+            return
+        teleState['steps'] += 1
+        minutes = max((time.monotonic() - teleState['start']) / 60, 1e-6)
+        teleQueue.append(json.dumps({
+            'robot': socket.gethostname(),
+            'protocol': metadata['protocolName'],
+            'step': step,
+            'lag': lag,
+            'tips': sum(1 for rack in teleRacks for w in rack.wells() if not w.has_tip),
+            'cpm': (teleState['cmds'] or teleState['steps']) / minutes,
+            't': time.time()}).encode())
+        while teleQueue:
+            try:
+                teleSock.sendto(teleQueue[0], telemetryTarget)
+            except OSError:
+                break
+            teleQueue.popleft()
+
+    # teleClose()
+    # Stop counting commands and close the socket at the end of the run
+    def teleClose():
+        if teleUnsub is not None:
+            teleUnsub()
+        if teleSock is not None:
+            teleSock.close()
+
+    # ----------------  END OF TELEMETRY        ----------------
+    # ----------------  TIMING CHECK            ----------------
+
+    # In simulation, simulation/timing.py records the run and fails it at the
+    # end when a timepoint can't be met; modelClock() is its estimate of the
+    # time so far. Inlined on purpose in every protocol with timepoints, the
+    # check itself lives in timing.watchRun(). Skipped where the simulation
+    # folder is not around, like on the robot
+    endTimingCheck = None
+    modelClock = None
+    if protocol.is_simulating():
+        simDir = os.path.join(os.path.dirname(os.path.abspath(
+            sys._getframe().f_code.co_filename)), 'simulation')
+        sys.path.insert(0, simDir)
+        try:
+            from timing import watchRun
+            endTimingCheck, modelClock = watchRun(protocol)
+        except ImportError:
+            protocol.comment('simulation/timing.py not found, timepoint schedule not checked')
+        finally:
+            sys.path.remove(simDir)
+
+    # ----------------  END OF TIMING CHECK     ----------------
+    # ----------------  TIP RACK REPLENISHMENT  ----------------
+
+    # tipsLeft(p)
+    # Pick-ups left in the racks of p from its starting tip on: fresh tips
+    # for a single channel, full columns of fresh tips for a multichannel
+    def tipsLeft(p):
+        wells = [w for rack in p.tip_racks for w in rack.wells()]
+        if p.starting_tip is not None:
+            names = [str(w) for w in wells]
+            wells = wells[names.index(str(p.starting_tip)):]
+        fresh = [w.has_tip for w in wells]
+        if p.channels == 1:
+            return sum(fresh)
+        return sum(1 for i in range(0, len(fresh) - 7, 8) if all(fresh[i:i + 8]))
+
+    # tipRefill(window, attended)
+    # Idle window check: racks of a pipette that can't cover its pick-ups
+    # until the next window are refilled here. When the operator is at the
+    # robot anyway (attended, or another rack is being refilled), racks that
+    # would run dry before the end of the run are batched in as well.
+    # Returns the operator prompt, '' when nothing needs refilling
+    def tipRefill(window, attended):
+        protocol.comment('@window %s' % window)
+        later = tipWindows[tipWindows.index(window):]
+        pips = [p300s, p300m]
+        must = [p for p in pips if tipsLeft(p) < tipDemand[window].get(p.mount, 0)]
+        batch = [p for p in pips if p not in must and (attended or must) and
+                 tipsLeft(p) < sum(tipDemand[w].get(p.mount, 0) for w in later)]
+        slots = []
+        for p in must + batch:
+            slots += [str(rack.parent) for rack in p.tip_racks]
+            p.reset_tipracks()
+        if not slots:
+            return ''
+        return 'Replace the tip rack(s) in slot %s with full racks. ' % ', '.join(sorted(slots))
+
+    # idleDelay(seconds, window)
+    # protocol.delay(seconds) that doubles as a tip refill window. The end of
+    # the delay is fixed before the refill prompt and the wait left is counted
+    # from it once the operator resumes, so resuming within the delay keeps
+    # the schedule
+    def idleDelay(seconds, window):
+        end = time.monotonic() + seconds
+        msg = tipRefill(window, False)
+        if msg:
+            protocol.pause(msg + 'Resume within %d s to keep the timepoint schedule.' % seconds)
+            # The pause holds the robot only at its next hardware command, a
+            # zero delay waits there until the operator resumes
+            protocol.delay(0)
+            if not protocol.is_simulating():
+                seconds = end - time.monotonic()
+        if seconds > 0:
+            protocol.delay(seconds)
+
+    # ----------------  END OF TIP RACK REPLENISHMENT ----------
+    # ----------------  TRAVEL HEIGHT           ----------------
+
+    # Moves between two labware normally arc over the tallest labware on the
+    # whole deck, the tube rack in slot 4. hop() instead clears only what
+    # lies under the path from one labware to the next: the two labware and
+    # the deck neighbours the pipette passes over, plus HOP_MARGIN. Paths
+    # that start, end or pass over slot 4 gain nothing and are left to the
+    # planner, so on this deck only the tip rack in slot 9 -> rxn plate leg
+    # of a timepoint hops; simulation/travelheight.py --all lists every pair.
+    # Inlined on purpose, the canonical copy is in 10TP-Quench-C3993.py and
+    # simulation/inlined.py reports copies that drifted from it
+    hopZ = {}
+
+    # slotSpan(slot)
+    # Deck footprint of slot as (x0, y0, x1, y1)
+    def slotSpan(slot):
+        corner = protocol.deck.position_for(slot).point
+        return corner.x, corner.y, corner.x + SLOT_SIZE[0], corner.y + SLOT_SIZE[1]
+
+    # pairZ(lwA, lwB)
+    # Travel height from labware lwA to lwB: the footprint of slot A swept
+    # over to slot B, checked against every occupied slot of the deck
+    def pairZ(lwA, lwB):
+        key = (str(lwA), str(lwB))
+        if key not in hopZ:
+            ax, ay, _, _ = slotSpan(lwA.parent)
+            bx, by, _, _ = slotSpan(lwB.parent)
+            steps = int(max(abs(bx - ax), abs(by - ay)) / HOP_STEP) + 1
+            tops = [lwA.highest_z, lwB.highest_z]
+            for slot, item in protocol.deck.items():
+                if item is None:
+                    continue
+                x0, y0, x1, y1 = slotSpan(slot)
+                for i in range(steps + 1):
+                    x = ax + (bx - ax) * i / steps
+                    y = ay + (by - ay) * i / steps
+                    if x < x1 and x + SLOT_SIZE[0] > x0 and y < y1 and y + SLOT_SIZE[1] > y0:
+                        tops.append(item.highest_z)
+                        break
+            hopZ[key] = max(tops) + HOP_MARGIN
+        return hopZ[key]
+
+    # hop(p, loc)
+    # Move p over to loc (a Location or a Well) at the travel height of its
+    # labware pair, ready for the aspirate, dispense or blow out at loc.
+    # Leaves moves within one labware, and pairs that clear no lower than
+    # the default arc, to the planner. The location cache is shared by both
+    # pipettes, so only hop while one pipette is working
+    def hop(p, loc):
+        if not isinstance(loc, Location):
+            loc = loc.top()
+        here = protocol.location_cache
+        if here is None:
+            return
+        lwA, _ = here.labware.get_parent_labware_and_well()
+        lwB, _ = loc.labware.get_parent_labware_and_well()
+        # Labware wrappers are new objects on every call, compare by name
+        if lwA is None or lwB is None or str(lwA) == str(lwB):
+            return
+        z = pairZ(lwA, lwB)
+        if z >= protocol.deck.highest_z + HOP_MARGIN:
+            return
+        p.move_to(Location(here.point._replace(z=z), here.labware), force_direct=True)
+        p.move_to(Location(loc.point._replace(z=z), loc.labware), force_direct=True)
+
+    # ----------------  END OF TRAVEL HEIGHT    ----------------
     # ----------------  START OF PROGRAM        ----------------
 
-    protocol.pause('Please confirm deck setup. Resume to start sequence.')
+    protocol.pause('Please confirm deck setup. ' + tipRefill('deck', True) +
+                   'Resume to start sequence.')
+    tele('deck confirmed')
 
-    # Fill C3694 Well A1-H10 w/ 25uL ea. quenching buffer, blow out last 10uL back into tube
+    # Fill C3694 Well A1-H10 w/ qBufWell uL ea. quenching buffer, blow out last 10uL back into tube
     p300s.pick_up_tip()
     for col in range(10):
+        tele('quench fill col %d' % (col + 1))
         # Aspirate each column 1-10
-        p300s.aspirate(210, qBuf, 0.5)
+        p300s.aspirate(fillVol, levelAsp(qBuf, fillVol), 0.5)
+        addVol(qBuf, -fillVol)
         for row in range(8):
-            # Pipette each row of column A-H 25uL
-            p300s.dispense(25, microP96_C3993.columns()[col][row])
+            # Pipette each row of column A-H qBufWell uL
+            p300s.dispense(qBufWell, quenchWells(col)[row])
+            addVol(quenchWells(col)[row], qBufWell)
         # Blow out rest in tip
         p300s.blow_out(qBuf)
+        addVol(qBuf, fillVol - 8 * qBufWell)
     p300s.drop_tip()
 
     # Prepare 8x 30uL lysate/lysis buffer + 240uL rxn buffer reaction mix w/o substrate
 
     # Lysate first
+    tele('lysate')
     lastE = '0'
     p300s.pick_up_tip()
     for row in range(8):
@@ -132,45 +486,76 @@ def run(protocol: protocol_api.ProtocolContext):
                 # Change tip upon content switch
                 p300s.drop_tip()
                 p300s.pick_up_tip()
-            p300s.transfer(30, lysate, rxnWells[row][1], new_tip='never')
+            p300s.transfer(30, levelAsp(lysate, 30), rxnWells[row][1], new_tip='never')
+            addVol(lysate, -30)
+            addVol(rxnWells[row][1], 30)
             lastE = 'E+'
         else:
             if lastE in 'E+':
                 # Change tip upon content switch
                 p300s.drop_tip()
                 p300s.pick_up_tip()
-            p300s.transfer(30, lysBuf, rxnWells[row][1], new_tip='never')
+            p300s.transfer(30, levelAsp(lysBuf, 30), rxnWells[row][1], new_tip='never')
+            addVol(lysBuf, -30)
+            addVol(rxnWells[row][1], 30)
             lastE = 'E-'
 
     p300s.drop_tip()
 
     # Rxn buffer acidification of lysate
+    tele('rxn buffer')
     # Pipette 240uL of reaction buffer in each well A1-H1
-    p300s.transfer(240, rBuf, rxnWells[0][0].columns_by_name()[
-                   '1'], new_tip='once')
+    bufCol = rxnWells[0][0].columns_by_name()['1']
+    p300s.transfer(240, levelAsp(rBuf, 240 * len(bufCol)), bufCol, new_tip='once')
+    addVol(rBuf, -240 * len(bufCol))
+    for well in bufCol:
+        addVol(well, 240)
 
     # Pause before starting rxn
     protocol.pause(
-        'Check if mixture and plate are ready. Resuming will start pipetting substrate.')
+        tipRefill('mixture', True) + 'Check if mixture and plate are ready. Resuming will start pipetting substrate.')
 
     # Add substrates
+    tele('substrate')
     p300m.pick_up_tip()
-    p300m.transfer(30, substrateWells[0][1],
+    p300m.transfer(30, levelAsp(substrateWells[0][1], 30),
                    rxnWells[0][1], new_tip='never')
+    addVol(substrateWells[0][1], -30)
+    addVol(rxnWells[0][1], 30)
+    # Reaction time zero, for the timing checker in simulation/timing.py
+    protocol.comment('@t0 rxn')
+    rxnT0 = time.monotonic()
     p300m.mix(5, 150)
     p300m.drop_tip()
     # Timepoint 1-10
+    # Due time of each timepoint after substrate addition, in s
+    timePoints = [60, 120, 180, 240, 300, 360, 420, 480, 540, 600]
     delayTimes = [16.85, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3]
     for tp in range(10):
         # delay first
         protocol.delay(delayTimes[tp])
-        # transfer to C3694
-        p300m.transfer(25, rxnWells[0][1],
-                       microP96_C3993.columns()[tp][0], True)
+        protocol.comment('@tp rxn %d %.1f' % (tp + 1, timePoints[tp]))
+        # transfer to C3694, hopping from the tip rack to the rxn plate
+        p300m.pick_up_tip()
+        src = levelAsp(rxnWells[0][1], sampleVol)
+        hop(p300m, src)
+        p300m.aspirate(sampleVol, src)
+        # lag of the sample against its due time, taken as it leaves the rxn well
+        lag = time.monotonic() - rxnT0 - timePoints[tp]
+        p300m.dispense(sampleVol, quenchWells(tp)[0])
+        p300m.drop_tip()
+        addVol(rxnWells[0][1], -sampleVol)
+        addVol(quenchWells(tp)[0], sampleVol)
+        tele('tp %d' % (tp + 1), lag)
 
     # Finalizing cleanup
     if p300m.has_tip:
         p300m.drop_tip()
     if p300s.has_tip:
         p300s.drop_tip()
+    tele('complete')
+    teleClose()
+    # Fails the simulation here if a timepoint can't be met
+    if endTimingCheck is not None:
+        endTimingCheck()
     protocol.pause('Sequence complete.')
@@ -1,4 +1,11 @@
 from dataclasses import dataclass
+import collections
+import json
+import math
+import os
+import socket
+import sys
+import time
 from multiprocessing.sharedctypes import Value
 from opentrons import protocol_api
 import opentrons
@@ -18,6 +25,10 @@ TO_DEF = 'default'
 
 OT2_DECK_SLOTS = 11  # Number of available deck slots in a OT-2 robot
 
+# For liquid level tracking
+IMMERSION = 2.0  # mm below the liquid surface to aspirate at
+TELE_QUEUE = 64  # telemetry records held while the network is busy
+
 # DATACLASS OF LABWARE DEFINITIONS
 
 
@@ -72,6 +83,17 @@ def run(protocol: protocol_api.ProtocolContext):
     defaultTipDiscardDest = TO_TRASH
     # defaultTipDiscardDest = TO_RACK
 
+    # Starting volumes in uL, for liquid level tracking
+    rBufVol = 10000     # slot 4 A1, 15mL tube
+    qBufVol = 10000     # slot 4 A2, 15mL tube
+    lysateVol = 1000    # slot 4 B1, 15mL tube
+    lysBufVol = 1000    # slot 4 C1, 15mL tube
+    subVol = 200        # each substrate well
+
+    # Telemetry collector: set to the (IP, UDP port) of the computer running
+    # simulation/telemetry.py, e.g. ('192.168.1.20', 9870). None sends nothing
+    telemetryTarget = None
+
     # ----------------  END OF RUN VARAIBLES    ----------------
 
     # ----------------  EQUIPMENT AND LABWARES  ----------------
@@ -248,59 +270,226 @@ def run(protocol: protocol_api.ProtocolContext):
                   ', fallback by using default discard method')
             defaultTipDisc(p, destSpot)
 
+    # Per-well volume ledger in uL, seeded from the starting volumes above
+    # and updated on every aspirate and dispense below
+    wellVol = {}
+    underflow = set()   # wells whose ledger ran below zero, warned once
+
+    # wellArea(well)
+    # Cross-section of well in mm^2. Tubes count as a cylinder of their top
+    # diameter, which puts the computed level at or below the real one in a
+    # conical bottom, so the tip never ends up above the liquid
+    def wellArea(well):
+        if well.diameter:
+            return math.pi * (well.diameter / 2) ** 2
+        return well.length * well.width
+
+    # wellShare(well, p)
+    # Number of channels of p drawing from or into well: all of them for a
+    # single-row reservoir, one per well otherwise
+    def wellShare(well, p):
+        if p is not None and len(well.parent.rows()) == 1:
+            return p.channels
+        return 1
+
+    # addVol(well, vol, p)
+    # Book vol uL per channel of p into well, negative vol for out of well.
+    # A well drawn below zero is reported once in the run log, the volumes
+    # the protocol moves are left as they are
+    def addVol(well, vol, p=None):
+        key = str(well)
+        wellVol[key] = wellVol.get(key, 0.0) + vol * wellShare(well, p)
+        if wellVol[key] < 0 and key not in underflow:
+            underflow.add(key)
+            protocol.comment('WARNING: volume ledger of %s is below zero (%.0f uL), '
+                             'check its starting volume and the volumes drawn from it' % (key, wellVol[key]))
+
+    # levelAsp(well, vol, minZ, p)
+    # Location to aspirate vol uL per channel of p from well: IMMERSION mm
+    # below the level left afterwards, no lower than minZ above the bottom.
+    # Wells without a ledger entry keep the fixed minZ height
+    def levelAsp(well, vol, minZ=1.0, p=None):
+        key = str(well)
+        if key not in wellVol:
+            return well.bottom(minZ)
+        left = wellVol[key] - vol * wellShare(well, p)
+        z = min(left / wellArea(well) - IMMERSION, well.depth - IMMERSION)
+        return well.bottom(max(minZ, z))
+
+    # Seed the liquid level ledger
+    for well, vol in [(rBuf, rBufVol), (qBuf, qBufVol), (lysate, lysateVol), (lysBuf, lysBufVol)]:
+        addVol(well, vol)
+    for sub in substrateWells:
+        addVol(sub.well, subVol)
+
     # ----------------  END OF HELPER FUNCTIONS ----------------
 
+    # ----------------  TELEMETRY               ----------------
+
+    # Live run telemetry: one small JSON datagram per step to the collector
+    # in simulation/telemetry.py. Sends never block; when the network can't
+    # keep up, the oldest queued records are dropped instead. The robot runs
+    # single-file protocols, so this block is inlined on purpose; the
+    # canonical copy is in 10TP-Quench-C3993.py and simulation/inlined.py
+    # reports copies that drifted from it
+    teleRacks = [lw for lw in protocol.loaded_labwares.values() if lw.is_tiprack]
+    teleSock = None
+    teleUnsub = None
+    teleQueue = collections.deque(maxlen=TELE_QUEUE)
+    teleState = {'start': time.monotonic(), 'steps': 0, 'cmds': 0}
+
+    # Count robot commands for commands per minute, where the API allows it
+    def teleCount(message):
+        if message.get('$') == 'before':
+            teleState['cmds'] += 1
+
+    if telemetryTarget and not protocol.is_simulating():
+        teleSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        teleSock.setblocking(False)
+        try:
+            teleUnsub = protocol.broker.subscribe('command', teleCount)
+        except AttributeError:
+            pass
+
+    # tele(step, lag)
+    # Queue a record of the current step, with the lag in s of a timepoint
+    # against its schedule, and send whatever the socket takes right now
+    def tele(step, lag=None):
+        if teleSock is None:
+            return
+        teleState['steps'] += 1
+        minutes = max((time.monotonic() - teleState['start']) / 60, 1e-6)
+        teleQueue.append(json.dumps({
+            'robot': socket.gethostname(),
+            'protocol': metadata['protocolName'],
+            'step': step,
+            'lag': lag,
+            'tips': sum(1 for rack in teleRacks for w in rack.wells() if not w.has_tip),
+            'cpm': (teleState['cmds'] or teleState['steps']) / minutes,
+            't': time.time()}).encode())
+        while teleQueue:
+            try:
+                teleSock.sendto(teleQueue[0], telemetryTarget)
+            except OSError:
+                break
+            teleQueue.popleft()
+
+    # teleClose()
+    # Stop counting commands and close the socket at the end of the run
+    def teleClose():
+        if teleUnsub is not None:
+            teleUnsub()
+        if teleSock is not None:
+            teleSock.close()
+
+    # ----------------  END OF TELEMETRY        ----------------
+    # ----------------  TIMING CHECK            ----------------
+
+    # In simulation, simulation/timing.py records the run and fails it at the
+    # end when a timepoint can't be met; modelClock() is its estimate of the
+    # time so far. Inlined on purpose in every protocol with timepoints, the
+    # check itself lives in timing.watchRun(). Skipped where the simulation
+    # folder is not around, like on the robot
+    endTimingCheck = None
+    modelClock = None
+    if protocol.is_simulating():
+        simDir = os.path.join(os.path.dirname(os.path.abspath(
+            sys._getframe().f_code.co_filename)), 'simulation')
+        sys.path.insert(0, simDir)
+        try:
+            from timing import watchRun
+            endTimingCheck, modelClock = watchRun(protocol)
+        except ImportError:
+            protocol.comment('simulation/timing.py not found, timepoint schedule not checked')
+        finally:
+            sys.path.remove(simDir)
+
+    # ----------------  END OF TIMING CHECK     ----------------
+
     # ----------------  START OF PROGRAM        ----------------
 
     # Fill C3694 Well A1-H10 w/ 25uL ea. quenching buffer, blow out last 10uL back into tube
     p300s.pick_up_tip()
     for col in range(10):
+        tele('quench fill col %d' % (col + 1))
         # Aspirate each column 1-10
-        p300s.aspirate(210, qBuf, 0.5)
+        p300s.aspirate(210, levelAsp(qBuf, 210), 0.5)
+        addVol(qBuf, -210)
         for row in range(8):
             # Pipette each row of column A-H 25uL
             p300s.dispense(25, microP96_C3694.columns()[col][row])
+            addVol(microP96_C3694.columns()[col][row], 25)
         # Blow out rest in tip
         p300s.blow_out(qBuf)
+        addVol(qBuf, 210 - 8 * 25)
     p300s.drop_tip()
 
     # Prepare 8x 30uL lysate/lysis buffer + 240uL rxn buffer reaction mix w/o substrate
 
     # Lysate first
+    tele('lysate')
     for row in range(8):
         # Pipette each row of column 1 A-H 30uL according to E+ or E- in well desc
         if 'E+' in rxnWells[row].desc:
-            p300s.transfer(30, lysate, rxnWells[row].well)
+            p300s.transfer(30, levelAsp(lysate, 30), rxnWells[row].well)
+            addVol(lysate, -30)
         else:
-            p300s.transfer(30, lysBuf, rxnWells[row].well)
+            p300s.transfer(30, levelAsp(lysBuf, 30), rxnWells[row].well)
+            addVol(lysBuf, -30)
+        addVol(rxnWells[row].well, 30)
 
     # Rxn buffer acidification of lysate
+    tele('rxn buffer')
     # Pipette 240uL of reaction buffer in each well A1-H1
-    p300s.transfer(30, rBuf, rxnWells[0].plate.columns_by_name()[
-                   '1'], new_tip='once')
+    bufCol = rxnWells[0].plate.columns_by_name()['1']
+    p300s.transfer(240, levelAsp(rBuf, 240 * len(bufCol)), bufCol, new_tip='once')
+    addVol(rBuf, -240 * len(bufCol))
+    for well in bufCol:
+        addVol(well, 240)
 
     # Pause before starting rxn
     protocol.pause(
         'Check if mixture and plate are ready. Resuming will start pipetting substrate.')
 
     # Add substrates
+    tele('substrate')
     p300m.pick_up_tip()
-    p300m.transfer(30, substrateWells[0].well,
+    p300m.transfer(30, levelAsp(substrateWells[0].well, 30),
                    rxnWells[0].well, new_tip='never')
+    addVol(substrateWells[0].well, -30)
+    addVol(rxnWells[0].well, 30)
+    # Reaction time zero, for the timing checker in simulation/timing.py
+    protocol.comment('@t0 rxn')
+    rxnT0 = time.monotonic()
     p300m.mix(5, 150)
     p300m.drop_tip()
     # Timepoint 1-10
+    # Due time of each timepoint after substrate addition, in s
+    timePoints = [60, 120, 180, 240, 300, 360, 420, 480, 540, 600]
     delayTimes = [16.85, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3, 35.3]
     for tp in range(10):
         # delay first
         protocol.delay(delayTimes[tp])
+        protocol.comment('@tp rxn %d %.1f' % (tp + 1, timePoints[tp]))
         # transfer to C3694
-        p300m.transfer(25, rxnWells[0].well,
-                       microP96_C3694.columns()[tp][0], True)
+        p300m.pick_up_tip()
+        p300m.aspirate(25, levelAsp(rxnWells[0].well, 25))
+        # lag of the sample against its due time, taken as it leaves the rxn well
+        lag = time.monotonic() - rxnT0 - timePoints[tp]
+        p300m.dispense(25, microP96_C3694.columns()[tp][0])
+        p300m.drop_tip()
+        addVol(rxnWells[0].well, -25)
+        addVol(microP96_C3694.columns()[tp][0], 25)
+        tele('tp %d' % (tp + 1), lag)
 
     # Finalizing cleanup
     if p300m.has_tip:
         p300m.drop_tip()
     if p300s.has_tip:
         p300s.drop_tip()
+    tele('complete')
+    teleClose()
+    # Fails the simulation here if a timepoint can't be met
+    if endTimingCheck is not None:
+        endTimingCheck()
     protocol.pause('Sequence complete.')
@@ -0,0 +1,280 @@
+import argparse
+import ast
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from cmdtrace import labwarePaths
+
+# Protocol analysis and startup profiler
+# The robot analyzes an uploaded protocol before it can run it: it imports
+# the file and runs run() against a simulated context. This profiler repeats
+# that analysis with opentrons.simulate and charges the time and memory it
+# takes to the protocol's own source lines:
+#
+#   self ms    time of the line itself and the library calls it makes
+#   incl ms    the same, with the protocol functions it calls
+#   KiB        memory the line allocated that is still held when run()
+#              returns, e.g. labware objects and lists of wells
+#
+# Time is sampled from a second thread by default; --exact traces every
+# protocol line instead, which is slower but misses no short line. Memory
+# is measured in a separate pass with tracemalloc so it does not skew the
+# timing. Each file is analyzed in a fresh interpreter, like on the robot,
+# so its imports are paid for again. Imports the code never uses are
+# listed too.
+#
+#   python analysisprofile.py ../*.py --top 10
+
+# GLOBAL VARIABLE DEFINITION
+
+SAMPLE_INTERVAL = 0.001  # s between samples
+TRACE_DEPTH = 30         # frames tracemalloc keeps per allocation
+TOP_LINES = 15
+PHASES = ['import', 'run', 'outside']  # outside: analysis code outside the protocol
+
+
+# unusedImports(source)
+# Imports of a protocol whose names the code never uses, as [(line, name)]
+def unusedImports(source):
+    tree = ast.parse(source)
+    imported = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imported[alias.asname or alias.name.split('.')[0]] = (node.lineno, alias.name)
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                imported[alias.asname or alias.name] = (
+                    node.lineno, '%s.%s' % (node.module or '', alias.name))
+    used = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    return sorted(place for name, place in imported.items() if name not in used)
+
+
+# _protocolFrames(frame, name)
+# Frames of the protocol file called name on the stack of frame, innermost
+# first. opentrons compiles the protocol under its file name
+def _protocolFrames(frame, name):
+    out = []
+    while frame is not None:
+        if os.path.basename(frame.f_code.co_filename) == name:
+            out.append(frame)
+        frame = frame.f_back
+    return out
+
+
+def _phase(frames):
+    if not frames:
+        return 'outside'
+    return 'import' if frames[-1].f_code.co_name == '<module>' else 'run'
+
+
+def _charge(lines, line, selfT, inclT):
+    entry = lines.setdefault(line, [0.0, 0.0, 0])
+    entry[0] += selfT
+    entry[1] += inclT
+
+
+# sampleLines(fn, name, interval)
+# Run fn with a thread sampling the stack of the caller every interval.
+# Returns ({line: [self s, incl s, bytes]}, {phase: s})
+def sampleLines(fn, name, interval=SAMPLE_INTERVAL):
+    target = threading.get_ident()
+    stop = threading.Event()
+    lines = {}
+    phases = dict.fromkeys(PHASES, 0.0)
+
+    def sampler():
+        last = time.perf_counter()
+        while not stop.wait(interval):
+            now = time.perf_counter()
+            # Weigh each sample by the time it stands for, the GIL makes
+            # the interval uneven
+            dt = now - last
+            last = now
+            frames = _protocolFrames(sys._current_frames().get(target), name)
+            phases[_phase(frames)] += dt
+            seen = set()
+            for i, frame in enumerate(frames):
+                if frame.f_lineno not in seen:
+                    seen.add(frame.f_lineno)
+                    _charge(lines, frame.f_lineno, dt if i == 0 else 0.0, dt)
+
+    thread = threading.Thread(target=sampler, daemon=True)
+    thread.start()
+    try:
+        fn()
+    finally:
+        stop.set()
+        thread.join()
+    return lines, phases
+
+
+# traceLines(fn, name)
+# Run fn tracing every line of the protocol file called name. A line is
+# charged the time up to the next line or return of its frame; time in
+# protocol functions it calls counts for its incl only.
+# Returns ({line: [self s, incl s, bytes]}, {phase: s})
+def traceLines(fn, name):
+    lines = {}
+    phases = dict.fromkeys(PHASES, 0.0)
+    state = {}  # frame -> [line, line start, child s, frame start, protocol caller, phase]
+
+    def close(frame, now):
+        line, start, child, _, caller, phase = state[frame]
+        # A line already on the stack, like a comprehension inside it, has
+        # its incl charged by the outer frame
+        outer = caller
+        while outer is not None and state[outer][0] != line:
+            outer = state[outer][4]
+        _charge(lines, line, now - start - child, 0.0 if outer is not None else now - start)
+        phases[phase] += now - start - child
+
+    def local(frame, event, arg):
+        now = time.perf_counter()
+        if event == 'line':
+            close(frame, now)
+            state[frame][0:3] = [frame.f_lineno, now, 0.0]
+        elif event == 'return':
+            close(frame, now)
+            _, _, _, begin, caller, _ = state.pop(frame)
+            if caller is not None:
+                state[caller][2] += now - begin
+        return local
+
+    def calls(frame, event, arg):
+        if os.path.basename(frame.f_code.co_filename) != name:
+            return None
+        callers = _protocolFrames(frame.f_back, name)
+        caller = callers[0] if callers and callers[0] in state else None
+        phase = state[caller][5] if caller is not None else _phase([frame])
+        now = time.perf_counter()
+        state[frame] = [frame.f_lineno, now, 0.0, now, caller, phase]
+        return local
+
+    start = time.perf_counter()
+    sys.settrace(calls)
+    try:
+        fn()
+    finally:
+        sys.settrace(None)
+    phases['outside'] = max(time.perf_counter() - start - phases['import'] - phases['run'], 0.0)
+    return lines, phases
+
+
+# allocLines(fn, name, lines)
+# Run fn under tracemalloc and add the bytes still held when the protocol's
+# run() returns to the innermost protocol line that allocated them. The
+# snapshot is taken on the return of run(), while its context, labware and
+# well lists are still alive; once simulate() returns they are freed.
+# Returns peak bytes
+def allocLines(fn, name, lines):
+    held = {}
+
+    def atReturn(frame, event, arg):
+        if event == 'return' and 'snapshot' not in held:
+            held['snapshot'] = tracemalloc.take_snapshot()
+        return atReturn
+
+    def calls(frame, event, arg):
+        if frame.f_code.co_name != 'run' or os.path.basename(frame.f_code.co_filename) != name or \
+                _protocolFrames(frame.f_back, name):
+            return None
+        # Only the return event of run() is wanted, not its lines
+        frame.f_trace_lines = False
+        return atReturn
+
+    tracemalloc.start(TRACE_DEPTH)
+    sys.settrace(calls)
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        sys.settrace(None)
+        tracemalloc.stop()
+    if 'snapshot' not in held:
+        raise RuntimeError('%s: run() never returned, no memory snapshot taken' % name)
+    for stat in held['snapshot'].statistics('traceback'):
+        for frame in reversed(stat.traceback):
+            if os.path.basename(frame.filename) == name:
+                lines.setdefault(frame.lineno, [0.0, 0.0, 0])[2] += stat.size
+                break
+    return peak
+
+
+# profileFile(path, exact, interval, alloc)
+# Analyze the protocol at path with opentrons.simulate and profile it.
+# Returns a dict of plain data, so it can come back from a child process
+def profileFile(path, exact=False, interval=SAMPLE_INTERVAL, alloc=True):
+    # The robot's analysis has the opentrons package loaded already
+    from opentrons import simulate
+    import timing
+
+    # The robot has no simulation folder, so it never runs the timing check
+    timing.RUN_WATCH = False
+
+    name = os.path.basename(path)
+    with open(path) as f:
+        source = f.read()
+    paths = labwarePaths()
+
+    def analyze():
+        with open(path) as f:
+            simulate.simulate(f, file_name=name, custom_labware_paths=paths)
+
+    start = time.perf_counter()
+    if exact:
+        lines, phases = traceLines(analyze, name)
+    else:
+        lines, phases = sampleLines(analyze, name, interval)
+    total = time.perf_counter() - start
+    peak = allocLines(analyze, name, lines) if alloc else 0
+    return {'name': name, 'total': total, 'phases': phases, 'lines': lines, 'peak': peak,
+            'source': source.splitlines(), 'unused': unusedImports(source)}
+
+
+def printReport(rep, top, sort):
+    col = {'self': 0, 'incl': 1, 'alloc': 2}[sort]
+    phases = rep['phases']
+    print('%s  analysis %.2f s: import %.2f s, run() %.2f s, outside protocol code %.2f s' % (
+        rep['name'], rep['total'], phases['import'], phases['run'], phases['outside']))
+    if rep['peak']:
+        print('  Peak traced memory %.0f KiB' % (rep['peak'] / 1024))
+    if rep['unused']:
+        print('  Unused imports: %s' % ', '.join('%s (line %d)' % (n, l) for l, n in rep['unused']))
+    print('  %5s %9s %9s %9s  %s' % ('line', 'self ms', 'incl ms', 'KiB', 'source'))
+    ranked = sorted([kv for kv in rep['lines'].items() if any(kv[1])], key=lambda kv: -kv[1][col])
+    for line, (selfT, inclT, size) in ranked[:top]:
+        text = rep['source'][line - 1].strip() if 0 < line <= len(rep['source']) else ''
+        print('  %5d %9.1f %9.1f %9.1f  %s' % (line, selfT * 1000, inclT * 1000, size / 1024, text[:70]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Profile protocol analysis and rank the protocol lines that make it slow')
+    parser.add_argument('protocols', nargs='+', help='protocol .py files')
+    parser.add_argument('--exact', action='store_true', help='trace every line instead of sampling')
+    parser.add_argument('--interval', type=float, default=SAMPLE_INTERVAL * 1000,
+                        help='ms between samples')
+    parser.add_argument('--no-alloc', action='store_true', help='skip the memory pass')
+    parser.add_argument('--sort', choices=['self', 'incl', 'alloc'], default='self')
+    parser.add_argument('--top', type=int, default=TOP_LINES, help='lines listed per file')
+    args = parser.parse_args()
+
+    # One fresh interpreter per file, one file at a time so they don't
+    # compete for the CPU
+    context = multiprocessing.get_context('spawn')
+    for path in args.protocols:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            rep = pool.submit(profileFile, os.path.abspath(path), args.exact,
+                              args.interval / 1000, not args.no_alloc).result()
+        printReport(rep, args.top, args.sort)
+        print()
+
+
+if __name__ == '__main__':
+    main()
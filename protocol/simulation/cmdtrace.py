@@ -0,0 +1,259 @@
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+# Command trace recording
+# Simulates a protocol file with opentrons.simulate and flattens its run log
+# into a list of Cmd records that the analysis tools in this folder share.
+#
+#   trace = simulateTrace('../10TP-Quench-C3993.py')
+
+# GLOBAL VARIABLE DEFINITION
+
+REPO_DIR = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+LABWARE_DIR = os.path.join(REPO_DIR, 'labware')
+
+# Run log text prefix -> command kind
+KIND_PREFIXES = [
+    ('Aspirating', 'aspirate'),
+    ('Dispensing', 'dispense'),
+    ('Mixing', 'mix'),
+    ('Blowing out', 'blow_out'),
+    ('Touching tip', 'touch_tip'),
+    ('Air gap', 'air_gap'),
+    ('Picking up tip', 'pick_up_tip'),
+    ('Dropping tip', 'drop_tip'),
+    ('Returning tip', 'return_tip'),
+    ('Moving to', 'move_to'),
+    ('Delaying', 'delay'),
+    ('Pausing', 'pause'),
+    ('Resuming', 'resume'),
+    ('Transferring', 'transfer'),
+    ('Distributing', 'distribute'),
+    ('Consolidating', 'consolidate'),
+    ('Homing', 'home'),
+]
+
+# Arc clearances used by the OT-2 motion planner, in mm
+WELL_Z_MARGIN = 5.0     # above the labware when staying in one labware
+LW_Z_MARGIN = 10.0      # above the tallest labware when changing labware
+SAME_POINT = 0.01       # points closer than this are the same location
+
+PLATE_ROWS = 'ABCDEFGHIJKLMNOP'
+CHANNELS = 8            # channels of a multichannel pipette
+
+
+@dataclass
+class Cmd:
+    # Dataclass for one command of a recorded protocol run
+    kind: str
+    text: str = ''
+    level: int = 0          # nesting depth, e.g. aspirates inside a transfer
+    pipette: str = ''       # instrument name and mount
+    labware: str = ''       # load name
+    slot: str = ''
+    well: str = ''
+    x: Optional[float] = None
+    y: Optional[float] = None
+    z: Optional[float] = None
+    lwTop: float = 0.0      # highest z of the labware, for arc heights
+    volume: float = 0.0
+    rate: float = 1.0       # flow rate multiplier
+    seconds: float = 0.0    # delays
+    reps: int = 0           # mixes
+    message: str = ''       # pauses and comments
+
+    def point(self):
+        if self.x is None:
+            return None
+        return (self.x, self.y, self.z)
+
+    def place(self):
+        # Identity of the labware the command happens in
+        return (self.slot, self.labware)
+
+
+# labwarePaths()
+# Every folder of custom labware definitions in the repo
+def labwarePaths():
+    paths = []
+    for root, dirs, files in os.walk(LABWARE_DIR):
+        if any(f.endswith('.json') for f in files):
+            paths.append(root)
+    return paths
+
+
+# simulateTrace(path)
+# Simulate the protocol file at path and return its command trace
+def simulateTrace(path):
+    from opentrons import simulate
+    import timing
+
+    # Record runs whose timepoints fail too, the tools report on them
+    timing.RUN_CHECK = False
+
+    with open(path) as f:
+        runlog, _ = simulate.simulate(
+            f, file_name=os.path.basename(path),
+            custom_labware_paths=labwarePaths())
+    return fromRunlog(runlog)
+
+
+def _kind(text):
+    for prefix, kind in KIND_PREFIXES:
+        if text.startswith(prefix):
+            return kind
+    return 'comment'
+
+
+# _where(loc)
+# Split a run log location (types.Location, Well or Labware) into
+# (point, well, labware)
+def _where(loc):
+    if loc is None:
+        return None, None, None
+    if hasattr(loc, 'point'):
+        point = loc.point
+        obj = getattr(loc.labware, 'object', loc.labware)
+    else:
+        obj = loc
+        point = loc.top().point if hasattr(loc, 'top') else None
+    if hasattr(obj, 'well_name'):
+        return point, obj, obj.parent
+    if hasattr(obj, 'load_name'):
+        return point, None, obj
+    return point, None, None
+
+
+# fromRunlog(runlog)
+# Convert the run log returned by opentrons.simulate into a list of Cmd
+def fromRunlog(runlog):
+    trace = []
+    lastPoint = {}
+    for entry in runlog:
+        payload = entry['payload']
+        text = payload.get('text', '')
+        cmd = Cmd(_kind(text), text, entry.get('level', 0))
+
+        instrument = payload.get('instrument')
+        if instrument is not None:
+            cmd.pipette = '%s@%s' % (instrument.name, instrument.mount)
+
+        point, well, lw = _where(payload.get('location'))
+        if well is not None:
+            cmd.well = well.well_name
+        if lw is not None:
+            cmd.labware = lw.load_name
+            cmd.slot = str(lw.parent)
+            cmd.lwTop = float(getattr(lw, 'highest_z', 0.0))
+        if point is None and cmd.pipette in lastPoint:
+            # Commands without a location happen where the pipette already is
+            point, cmd.well, cmd.labware, cmd.slot, cmd.lwTop = lastPoint[cmd.pipette]
+        if point is not None:
+            cmd.x, cmd.y, cmd.z = float(point[0]), float(point[1]), float(point[2])
+            if cmd.pipette:
+                lastPoint[cmd.pipette] = (cmd.point(), cmd.well, cmd.labware,
+                                          cmd.slot, cmd.lwTop)
+
+        cmd.volume = float(payload.get('volume') or 0.0)
+        cmd.rate = float(payload.get('rate') or 1.0)
+        cmd.seconds = float(payload.get('seconds') or 0.0) + \
+            60.0 * float(payload.get('minutes') or 0.0)
+        cmd.reps = int(payload.get('repetitions') or 0)
+        cmd.message = payload.get('userMessage') or (
+            text if cmd.kind == 'comment' else '')
+        trace.append(cmd)
+    return trace
+
+
+# leaves(trace)
+# Only the commands that move hardware themselves, dropping compound
+# parents such as transfer and mix whose children are in the trace
+def leaves(trace):
+    out = []
+    for i in range(len(trace)):
+        if i + 1 < len(trace) and trace[i + 1].level > trace[i].level:
+            continue
+        out.append(trace[i])
+    return out
+
+
+# deckTop(trace)
+# Highest labware seen in the trace, the height arcs between labware clear
+def deckTop(trace):
+    return max([c.lwTop for c in trace] + [0.0])
+
+
+# channelWells(cmd)
+# Wells the channels of cmd's pipette are in. The run log names only the
+# well of the back channel of a multichannel pipette; the others follow it
+# down the column, every other row on a 384-well plate, and all sit in the
+# one well of a reservoir column
+def channelWells(cmd):
+    if 'multi' not in cmd.pipette or not cmd.well:
+        return [cmd.well]
+    if 'reservoir' in cmd.labware:
+        return [cmd.well] * CHANNELS
+    step = 2 if '384' in cmd.labware else 1
+    row = PLATE_ROWS.index(cmd.well[0])
+    return ['%s%s' % (PLATE_ROWS[row + step * i], cmd.well[1:]) for i in range(CHANNELS)]
+
+
+# waypoint(cmd)
+# Whether cmd is a move_to well above its labware, the kind hop() in the
+# protocols makes with force_direct to travel at a lower height
+def waypoint(cmd):
+    return cmd.kind == 'move_to' and cmd.z is not None and cmd.z > cmd.lwTop + WELL_Z_MARGIN
+
+
+# moveCost(a, b, top)
+# Planner-style arc between the locations of commands a and b:
+# returns (xy, z) travel in mm. A move to a waypoint goes straight there
+def moveCost(a, b, top):
+    pa, pb = a.point(), b.point()
+    if pa is None or pb is None:
+        return 0.0, 0.0
+    xy = math.hypot(pb[0] - pa[0], pb[1] - pa[1])
+    if waypoint(b):
+        return xy, abs(pb[2] - pa[2])
+    if xy < SAME_POINT and a.place() == b.place():
+        # Straight up or down inside one well
+        return 0.0, abs(pb[2] - pa[2])
+    if a.place() == b.place() and a.pipette == b.pipette:
+        safeZ = max(a.lwTop, pa[2], pb[2]) + WELL_Z_MARGIN
+    else:
+        safeZ = max(top, pa[2], pb[2]) + LW_Z_MARGIN
+    return xy, (safeZ - pa[2]) + (safeZ - pb[2])
+
+
+# travel(trace)
+# Total (xy, z) travel of the head over the located leaf commands of trace
+def travel(trace):
+    top = deckTop(trace)
+    xy = z = 0.0
+    prev = None
+    for cmd in leaves(trace):
+        if cmd.point() is None:
+            continue
+        if prev is not None:
+            dxy, dz = moveCost(prev, cmd, top)
+            xy += dxy
+            z += dz
+        prev = cmd
+    return xy, z
+
+
+# saveTrace(trace, path) / loadTrace(path)
+# Store a trace as one JSON object per line
+def saveTrace(trace, path):
+    with open(path, 'w') as f:
+        for cmd in trace:
+            f.write(json.dumps(asdict(cmd)) + '\n')
+
+
+def loadTrace(path):
+    with open(path) as f:
+        return [Cmd(**json.loads(line)) for line in f if line.strip()]
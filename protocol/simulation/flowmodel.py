@@ -0,0 +1,311 @@
+import argparse
+import json
+import re
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from cmdtrace import CHANNELS, channelWells, leaves, loadTrace
+from timing import FLOW_RE
+
+# Flow rate speed versus accuracy model
+# Monte Carlo model of a simulated run: every aspirate and dispense moves a
+# volume with an error that depends on the volume, the flow rate, the
+# pipette and the liquid class of what it moves. The errors are carried
+# through the tips and wells of the whole plan to the share of every source
+# liquid in every destination well. Every channel of a multichannel
+# pipette is its own tip with its own errors. All samples of one step are drawn and
+# moved at once, so a full 384-well plan takes a fraction of a second.
+#
+# The search picks the fastest aspirate and dispense rate per pipette that
+# keeps the CV of every destination below a target:
+#
+#   python flowmodel.py ../10TP-Quench-C3993.py --liquid 4:B1=lysate --cv 0.05
+
+# GLOBAL VARIABLE DEFINITION
+
+# Error model per liquid class. At flow rate r the volume error grows by
+# g = (r / knee)^2:
+#   sd   = sqrt((cv * vol)^2 + (floor * sqrt(pipette uL / 20))^2) * (1 + g)
+#   mean = vol * (1 - bias * g)
+# cv: relative random error of slow pipetting; floor: uL of random error
+# that doesn't shrink with the volume, for a 20 uL pipette; knee: uL/s at
+# which errors have doubled; bias: volume lost at the knee rate, as a share
+LIQUID_CLASSES = {
+    'aqueous': {'cv': 0.005, 'floor': 0.05, 'knee': 150.0, 'bias': 0.005},
+    'lysate': {'cv': 0.01, 'floor': 0.1, 'knee': 60.0, 'bias': 0.02},
+    'viscous': {'cv': 0.015, 'floor': 0.15, 'knee': 25.0, 'bias': 0.05},
+    'volatile': {'cv': 0.02, 'floor': 0.1, 'knee': 100.0, 'bias': -0.01},
+}
+DEFAULT_CLASS = 'aqueous'
+
+# Flow rates tried by the search, in uL/s, up to the pipette's nominal
+# volume per second
+RATE_GRID = [2.0, 3.5, 5.0, 7.56, 10.0, 15.0, 20.0, 25.0, 30.0, 40.0, 50.0,
+             60.0, 75.0, 92.86, 100.0, 125.0, 150.0, 200.0, 250.0, 300.0]
+
+N_SAMPLES = 2000        # Monte Carlo samples per run
+SOURCE_VOL = 1.0e6      # uL of a source well, never the limit
+MIN_SHARE = 0.01        # smallest share of a liquid in a well that counts for its CV
+CV_TARGET = 0.05
+PIPETTE_RE = re.compile(r'p(\d+)_')
+
+
+@dataclass
+class OpDef:
+    # Dataclass for one liquid handling step of a compiled plan
+    kind: str           # aspirate, dispense, blow_out or tip (pick up / drop)
+    pipette: str
+    well: str = ''      # 'slot:well'
+    volume: float = 0.0
+    rate: float = 0.0   # uL/s in the simulated run, 0 when unknown
+    size: float = 20.0  # nominal pipette volume, uL
+    channel: int = 0    # channel of a multichannel pipette
+
+
+# compilePlan(trace)
+# The steps of a trace that move liquid or change tips, as OpDef, one per
+# channel of multichannel pipettes
+def compilePlan(trace):
+    plan = []
+    for cmd in leaves(trace):
+        if cmd.kind in ('pick_up_tip', 'drop_tip', 'return_tip'):
+            channels = CHANNELS if 'multi' in cmd.pipette else 1
+            plan.extend(OpDef('tip', cmd.pipette, channel=c) for c in range(channels))
+            continue
+        if cmd.kind not in ('aspirate', 'dispense', 'blow_out') or not cmd.well:
+            continue
+        flow = FLOW_RE.search(cmd.text)
+        size = PIPETTE_RE.match(cmd.pipette)
+        for c, well in enumerate(channelWells(cmd)):
+            plan.append(OpDef(cmd.kind, cmd.pipette, '%s:%s' % (cmd.slot, well), cmd.volume,
+                              float(flow.group(1)) if flow else 0.0,
+                              float(size.group(1)) if size else 20.0, c))
+    return plan
+
+
+def groups(plan):
+    return sorted({(op.pipette, op.kind) for op in plan if op.kind in ('aspirate', 'dispense')})
+
+
+# planRates(plan)
+# Flow rates of every (pipette, kind) group as simulated, lowest first
+def planRates(plan):
+    rates = {}
+    for op in plan:
+        if op.kind in ('aspirate', 'dispense') and op.rate:
+            rates.setdefault((op.pipette, op.kind), set()).add(op.rate)
+    return {g: sorted(r) for g, r in rates.items()}
+
+
+# planTime(plan, rates)
+# Seconds spent aspirating and dispensing at rates per (pipette, kind)
+# group, or at the rate of every step as simulated when rates is None.
+# Channels move together, so only channel 0 counts
+def planTime(plan, rates=None):
+    total = 0.0
+    for op in plan:
+        if op.kind not in ('aspirate', 'dispense') or op.channel:
+            continue
+        rate = op.rate if rates is None else rates.get((op.pipette, op.kind))
+        if rate:
+            total += op.volume / rate
+    return total
+
+
+def _empty(n):
+    return [np.zeros(n), {}]
+
+
+# _move(src, dst, vol)
+# Move vol (per sample) from src to dst, both [volume, {liquid: amount}],
+# keeping the mixture of src
+def _move(src, dst, vol):
+    vol = np.minimum(vol, src[0])
+    share = np.divide(vol, src[0], out=np.zeros_like(vol), where=src[0] > 0)
+    for liquid, amount in src[1].items():
+        part = amount * share
+        amount -= part
+        if liquid in dst[1]:
+            dst[1][liquid] += part
+        else:
+            dst[1][liquid] = part
+    src[0] = src[0] - vol
+    dst[0] = dst[0] + vol
+
+
+# _class(content, liquids)
+# Liquid class of the liquid making up most of content
+def _class(content, liquids):
+    if not content[1]:
+        return DEFAULT_CLASS
+    main = max(content[1], key=lambda liquid: content[1][liquid].mean())
+    return liquids.get(main, DEFAULT_CLASS)
+
+
+# simulate(plan, rates, liquids, n, seed, classes)
+# Run the plan n times with random volume errors, with rates per (pipette,
+# kind) group, or for groups missing in rates at the rate of every step as
+# simulated. Returns the share of every
+# source liquid in every destination well as {well: {liquid: array(n)}}.
+# Sources are the wells first touched by an aspirate, destinations the wells
+# dispensed into and never aspirated from
+def simulate(plan, rates, liquids=None, n=N_SAMPLES, seed=0, classes=None):
+    liquids = liquids or {}
+    classes = classes or LIQUID_CLASSES
+    rng = np.random.default_rng(seed)
+    wells = {}
+    tips = {}
+    drawn = set()
+    filled = set()
+    for op in plan:
+        if op.kind == 'tip':
+            tips[(op.pipette, op.channel)] = _empty(n)
+            continue
+        tip = tips.setdefault((op.pipette, op.channel), _empty(n))
+        if op.well not in wells:
+            if op.kind == 'aspirate':
+                wells[op.well] = [np.full(n, SOURCE_VOL), {op.well: np.full(n, SOURCE_VOL)}]
+            else:
+                wells[op.well] = _empty(n)
+        well = wells[op.well]
+        if op.kind == 'blow_out':
+            _move(tip, well, tip[0])
+        else:
+            c = classes[_class(well if op.kind == 'aspirate' else tip, liquids)]
+            rate = rates.get((op.pipette, op.kind)) or op.rate or c['knee']
+            g = (rate / c['knee']) ** 2
+            sd = np.hypot(c['cv'] * op.volume, c['floor'] * np.sqrt(op.size / 20.0)) * (1 + g)
+            vol = np.maximum(op.volume * (1 - c['bias'] * g) + sd * rng.standard_normal(n), 0.0)
+            if op.kind == 'aspirate':
+                _move(well, tip, vol)
+                drawn.add(op.well)
+                continue
+            _move(tip, well, vol)
+        filled.add(op.well)
+
+    out = {}
+    for key in sorted(filled - drawn):
+        vol, content = wells[key]
+        safe = np.where(vol > 0, vol, 1.0)
+        out[key] = {liquid: amount / safe for liquid, amount in content.items()}
+    return out
+
+
+# wellCvs(shares)
+# Worst CV of every destination over the liquids making up at least
+# MIN_SHARE of it
+def wellCvs(shares):
+    cvs = {}
+    for key, content in shares.items():
+        worst = 0.0
+        for share in content.values():
+            mean = share.mean()
+            if mean >= MIN_SHARE:
+                worst = max(worst, share.std() / mean)
+        cvs[key] = worst
+    return cvs
+
+
+def worstCv(plan, rates, liquids, n, seed, classes):
+    cvs = wellCvs(simulate(plan, rates, liquids, n, seed, classes))
+    return max(cvs.values()) if cvs else 0.0
+
+
+# fastestRates(plan, target, liquids, n, seed, classes)
+# Fastest rate per (pipette, kind) group that keeps every destination CV
+# at or below target. Groups are raised in turn, the one with the most
+# pipetting time first, each to the highest grid rate that still meets the
+# target with the others fixed, until no group can be raised further. The
+# same seed is used throughout, so rates are compared on the same errors.
+# Returns (rates, worst CV), None for rates when even the slowest miss
+def fastestRates(plan, target=CV_TARGET, liquids=None, n=N_SAMPLES, seed=0, classes=None):
+    grid = {}
+    for op in plan:
+        if op.kind in ('aspirate', 'dispense'):
+            grid[(op.pipette, op.kind)] = [r for r in RATE_GRID if r <= op.size] or RATE_GRID[:1]
+    order = sorted(grid, key=lambda g: -planTime(
+        [op for op in plan if (op.pipette, op.kind) == g]))
+    idx = dict.fromkeys(grid, 0)
+
+    def ratesOf(choice):
+        return {g: grid[g][i] for g, i in choice.items()}
+
+    if worstCv(plan, ratesOf(idx), liquids, n, seed, classes) > target:
+        return None, worstCv(plan, ratesOf(idx), liquids, n, seed, classes)
+    changed = True
+    while changed:
+        changed = False
+        for g in order:
+            # Errors only grow with the rate, so search for the last rate
+            # that meets the target
+            lo, hi = idx[g], len(grid[g]) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                trial = dict(idx)
+                trial[g] = mid
+                if worstCv(plan, ratesOf(trial), liquids, n, seed, classes) <= target:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            if lo != idx[g]:
+                idx[g] = lo
+                changed = True
+    rates = ratesOf(idx)
+    return rates, worstCv(plan, rates, liquids, n, seed, classes)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find the fastest flow rates that keep destination CVs under a target')
+    parser.add_argument('protocol', help='protocol .py file, or a saved .jsonl trace')
+    parser.add_argument('--cv', type=float, default=CV_TARGET, help='CV target per destination well')
+    parser.add_argument('--liquid', nargs='*', default=[],
+                        help='liquid class of a source well, e.g. 4:B1=lysate')
+    parser.add_argument('--classes', help='JSON file of liquid classes to add or replace')
+    parser.add_argument('--samples', type=int, default=N_SAMPLES, help='Monte Carlo samples')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.protocol.endswith('.jsonl'):
+        trace = loadTrace(args.protocol)
+    else:
+        from simcache import cachedTrace
+        trace, _ = cachedTrace(args.protocol)
+    classes = dict(LIQUID_CLASSES)
+    if args.classes:
+        with open(args.classes) as f:
+            classes.update(json.load(f))
+    liquids = dict(item.split('=') for item in args.liquid)
+
+    plan = compilePlan(trace)
+    base = planRates(plan)
+    start = time.perf_counter()
+    cvs = wellCvs(simulate(plan, {}, liquids, args.samples, args.seed, classes))
+    took = time.perf_counter() - start
+    print('%d channel steps, %d destination wells, %.3f s per model run' % (len(plan), len(cvs), took))
+    if cvs:
+        print('Worst destination CV as simulated: %.4f' % max(cvs.values()))
+
+    rates, worst = fastestRates(plan, args.cv, liquids, args.samples, args.seed, classes)
+    if rates is None:
+        print('No rates meet CV %.4f, slowest rates give %.4f' % (args.cv, worst))
+        return
+    print('%-28s %-9s %14s %10s' % ('pipette', 'step', 'simulated', 'fastest'))
+    for (pipette, kind) in groups(plan):
+        sim = base.get((pipette, kind))
+        if not sim:
+            shown = '-'
+        elif len(sim) == 1:
+            shown = '%.2f' % sim[0]
+        else:
+            shown = '%.2f-%.2f' % (sim[0], sim[-1])
+        print('%-28s %-9s %14s %10.2f' % (pipette, kind, shown, rates[(pipette, kind)]))
+    print('Worst destination CV at the fastest rates: %.4f (target %.4f)' % (worst, args.cv))
+    print('Aspirate and dispense time: %.1f s as simulated, %.1f s at the fastest rates' % (
+        planTime(plan), planTime(plan, rates)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import difflib
+import glob
+import os
+import sys
+
+# Inlined block check
+# The robot runs single-file protocols, so the helper blocks the protocols
+# share are pasted into each of them between their section markers. One
+# protocol holds the canonical copy of each block; this check reports every
+# other copy that drifted from it and exits with 1 when one did.
+#
+#   python inlined.py           # summary
+#   python inlined.py --diff    # with the differences
+
+# GLOBAL VARIABLE DEFINITION
+
+PROTOCOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Section name -> protocol with the canonical copy
+BLOCKS = {
+    'TELEMETRY': '10TP-Quench-C3993.py',
+    'TIP RACK REPLENISHMENT': '10TP-Quench-C3993.py',
+    'TIMING CHECK': '10TP-Quench-C3993.py',
+    'TRAVEL HEIGHT': '10TP-Quench-C3993.py',
+}
+
+
+# block(path, name)
+# Lines between the section markers of name in the file at path, None
+# when the file doesn't have the section
+def block(path, name):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    start = end = None
+    for i, line in enumerate(lines):
+        text = line.strip()
+        if not text.startswith('# ----------------'):
+            continue
+        title = text.strip('# -')
+        if start is None and title == name:
+            start = i + 1
+        elif start is not None and title == 'END OF ' + name:
+            end = i
+            break
+    if start is None or end is None:
+        return None
+    return lines[start:end]
+
+
+# drifted()
+# (name, file, diff lines) of every copy that differs from its canonical one
+def drifted():
+    out = []
+    paths = sorted(glob.glob(os.path.join(PROTOCOL_DIR, '*.py')))
+    for name, canonical in BLOCKS.items():
+        ref = block(os.path.join(PROTOCOL_DIR, canonical), name)
+        for path in paths:
+            if os.path.basename(path) == canonical:
+                continue
+            copy = block(path, name)
+            if copy is None or copy == ref:
+                continue
+            diff = list(difflib.unified_diff(
+                ref, copy, canonical, os.path.basename(path), lineterm=''))
+            out.append((name, os.path.basename(path), diff))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report inlined protocol blocks that drifted from their canonical copy')
+    parser.add_argument('--diff', action='store_true', help='print the differences')
+    args = parser.parse_args()
+
+    found = drifted()
+    for name, fileName, diff in found:
+        print('%s in %s differs from %s' % (name, fileName, BLOCKS[name]))
+        if args.diff:
+            print('\n'.join(diff))
+    if not found:
+        print('All inlined blocks match their canonical copy')
+    sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import math
+from dataclasses import dataclass, field
+
+from cmdtrace import channelWells, leaves, loadTrace
+
+# Manual step consolidator and operator manifest
+# Manual steps are declared in the protocols just before the pause that
+# asks for them:
+#
+#   protocol.comment('@manual lysate 6:A1,B1,C1 30 anyorder after=thaw')
+#
+# a task name, the wells it fills (slot:wells, or slot:colN for a column),
+# uL per well, and options: 'anyorder' when robot dispenses into the same
+# wells may come after it, 'after=' other tasks it has to follow. The planner
+# moves every task to the earliest pause no robot step it depends on stands
+# in front of, and lists which pauses are then left with nothing to do.
+# The manifest lists what the operator prepares up front: reagents the robot
+# draws with dead volume, manual additions with overage, and tip racks.
+#
+#   python manualplan.py ../10TP-QuenchLong-C3993.py --name 4:A2=qBuf 4:A1=rBuf
+
+# GLOBAL VARIABLE DEFINITION
+
+ROWS = 'ABCDEFGH'
+RACK_TIPS = 96
+MANUAL_OVERAGE = 0.1    # share prepared on top of manual additions
+
+# Dead volume in uL of a source well, by labware load name pattern. The
+# mixed Falcon rack has its 50 mL tubes in columns 3 and 4
+DEAD_VOL = [
+    ('4x50ml_6x15ml', {'3': 3000, '4': 3000}, 1000),
+    ('50ml', {}, 3000),
+    ('15ml', {}, 1000),
+    ('reservoir', {}, 1500),
+    ('1.5ml', {}, 30),
+    ('2ml', {}, 30),
+    ('wellplate', {}, 10),
+    ('pcr', {}, 5),
+]
+DEFAULT_DEAD = 20
+
+
+@dataclass
+class TaskDef:
+    # Dataclass for one manual step
+    name: str
+    slot: str
+    wells: list
+    vol: float              # uL per well
+    anyorder: bool = False
+    after: list = field(default_factory=list)
+    at: int = 0             # trace index of its marker
+    pause: int = -1         # index into the pause list, declared
+    moved: int = -1         # index into the pause list, planned
+
+
+def _wells(spec):
+    if spec.startswith('col'):
+        return ['%s%s' % (row, spec[3:]) for row in ROWS]
+    return spec.split(',')
+
+
+# parseTasks(trace)
+# Manual steps of a trace, and its pauses as (trace index, message)
+def parseTasks(trace):
+    tasks = []
+    pauses = []
+    for i, cmd in enumerate(trace):
+        if cmd.kind == 'pause':
+            for task in tasks:
+                if task.pause < 0:
+                    task.pause = len(pauses)
+            pauses.append((i, cmd.message))
+        elif cmd.kind == 'comment' and cmd.message.startswith('@manual '):
+            parts = cmd.message.split()
+            slot, spec = parts[2].split(':')
+            task = TaskDef(parts[1], slot, _wells(spec), float(parts[3]), at=i)
+            for opt in parts[4:]:
+                if opt == 'anyorder':
+                    task.anyorder = True
+                elif opt.startswith('after='):
+                    task.after = opt[len('after='):].split(',')
+            tasks.append(task)
+    return tasks, pauses
+
+
+# _blocks(task, cmd)
+# Whether robot command cmd has to stay after task when any channel of it
+# touches the task's wells
+def _blocks(task, cmd):
+    if cmd.slot != task.slot or not any(w in task.wells for w in channelWells(cmd)):
+        return False
+    if cmd.kind == 'aspirate':
+        return True
+    return cmd.kind in ('dispense', 'blow_out') and not task.anyorder
+
+
+# consolidate(trace)
+# Plan every task into its earliest pause. Returns (tasks, pauses, idle):
+# tasks with .moved set, and the indices of pauses that declared tasks and
+# were left with none
+def consolidate(trace):
+    trace = leaves(trace)
+    tasks, pauses = parseTasks(trace)
+    byName = {t.name: t for t in tasks}
+    for task in tasks:
+        if task.pause < 0:
+            # No pause after the marker, nothing to move
+            continue
+        earliest = 0
+        for dep in task.after:
+            if dep in byName and byName[dep].moved >= 0:
+                earliest = max(earliest, byName[dep].moved)
+        task.moved = task.pause
+        for p in range(task.pause - 1, earliest - 1, -1):
+            start = pauses[p][0]
+            if any(_blocks(task, cmd) for cmd in trace[start:pauses[p + 1][0]]):
+                break
+            task.moved = p
+    declared = {t.pause for t in tasks if t.pause >= 0}
+    kept = {t.moved for t in tasks if t.moved >= 0}
+    return tasks, pauses, sorted(declared - kept)
+
+
+def deadVolume(labware, well):
+    for pattern, byColumn, vol in DEAD_VOL:
+        if pattern in labware:
+            return byColumn.get(well[1:], vol)
+    return DEFAULT_DEAD
+
+
+# manifest(trace)
+# Reagents the robot draws as {(slot, labware, well): uL net}, counting
+# blow outs back into a source, and tips picked per (slot, labware) rack
+# as {(slot, labware): tips}. Every channel of a multichannel pipette
+# counts in the well it is in, all eight in the one well of a reservoir
+def manifest(trace):
+    drawn = {}
+    filled = set()
+    tips = {}
+    inTip = {}
+    for cmd in leaves(trace):
+        if cmd.kind == 'pick_up_tip':
+            tips[(cmd.slot, cmd.labware)] = tips.get((cmd.slot, cmd.labware), 0) + len(channelWells(cmd))
+            inTip[cmd.pipette] = 0.0
+            continue
+        if cmd.kind not in ('aspirate', 'dispense', 'blow_out'):
+            continue
+        # The channels hold the same volume, one tip per pipette stands for all
+        held = inTip.get(cmd.pipette, 0.0)
+        if cmd.kind == 'aspirate':
+            inTip[cmd.pipette] = held + cmd.volume
+        elif cmd.kind == 'dispense':
+            inTip[cmd.pipette] = max(held - cmd.volume, 0.0)
+        else:
+            inTip[cmd.pipette] = 0.0
+        for well in channelWells(cmd):
+            key = (cmd.slot, cmd.labware, well)
+            if cmd.kind == 'aspirate':
+                if key not in filled:
+                    drawn[key] = drawn.get(key, 0.0) + cmd.volume
+            elif cmd.kind == 'dispense':
+                if key in drawn:
+                    drawn[key] -= cmd.volume
+                else:
+                    filled.add(key)
+            elif key in drawn:
+                drawn[key] -= held
+    return drawn, tips
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Batch manual steps into early pauses and print the operator manifest')
+    parser.add_argument('protocol', help='protocol .py file, or a saved .jsonl trace')
+    parser.add_argument('--name', nargs='*', default=[],
+                        help='reagent name of a source well, e.g. 4:A2=qBuf')
+    args = parser.parse_args()
+
+    if args.protocol.endswith('.jsonl'):
+        trace = loadTrace(args.protocol)
+    else:
+        from simcache import cachedTrace
+        trace, _ = cachedTrace(args.protocol)
+    names = dict(item.split('=') for item in args.name)
+
+    tasks, pauses, idle = consolidate(trace)
+    print('Pauses:')
+    for p, (_, message) in enumerate(pauses):
+        here = [t.name for t in tasks if t.moved == p]
+        print('  %d  %-60s %s' % (p, message[:60], ', '.join(here)))
+    print('Manual steps:')
+    for task in tasks:
+        if task.pause < 0:
+            print('  %-16s no pause follows its marker' % task.name)
+        elif task.moved < task.pause:
+            print('  %-16s move from pause %d to pause %d' % (task.name, task.pause, task.moved))
+        else:
+            print('  %-16s stays at pause %d' % (task.name, task.pause))
+    for p in idle:
+        print('Pause %d only held manual steps that moved: drop it unless "%s" asks for more' % (
+            p, pauses[p][1][:60]))
+
+    drawn, tips = manifest(trace)
+    print('Operator manifest')
+    print('  Reagents on deck:')
+    for (slot, labware, well), vol in sorted(drawn.items()):
+        dead = deadVolume(labware, well)
+        print('    %-8s slot %-2s %-4s %-44s %8.0f uL + %5.0f dead = %8.0f uL' % (
+            names.get('%s:%s' % (slot, well), ''), slot, well, labware[:44], vol, dead, vol + dead))
+    if tasks:
+        print('  Manual additions:')
+        for task in tasks:
+            total = task.vol * len(task.wells)
+            print('    %-16s %d wells x %.0f uL = %.0f uL, prepare %.0f uL' % (
+                task.name, len(task.wells), task.vol, total, total * (1 + MANUAL_OVERAGE)))
+    print('  Tip racks:')
+    for (slot, labware), n in sorted(tips.items()):
+        print('    slot %-2s %-36s %4d tips, %d rack(s)' % (slot, labware, n, math.ceil(n / RACK_TIPS)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import math
+from dataclasses import replace
+
+from cmdtrace import SAME_POINT, leaves, loadTrace, saveTrace, travel, waypoint
+from simcache import cachedTrace
+
+# Peephole optimizer for recorded command plans
+# Flattens a trace to the commands that move hardware and rewrites short
+# windows of it until nothing changes:
+#   - moves that do not go anywhere are removed
+#   - a move followed by another move, or by a command at the same location,
+#     is merged into the later command, unless it is a travel height
+#     waypoint: the planner would arc the later command over the deck again
+#   - consecutive aspirates (or dispenses) at one location become one
+#   - back-to-back aspirate/dispense round trips at one location become a mix;
+#     only round trips that were not already a mix() count
+#
+#   python peephole.py ../10TP-Quench-C3993-Eco.py -o eco_optimized.jsonl
+
+# GLOBAL VARIABLE DEFINITION
+
+RULES = ['noop_move', 'merged_move', 'fused_liquid', 'fused_mix']
+
+
+def _samePoint(a, b):
+    pa, pb = a.point(), b.point()
+    if pa is None or pb is None:
+        return False
+    return math.dist(pa, pb) < SAME_POINT and a.place() == b.place()
+
+
+def _liquid(a, b, kind):
+    # a and b are the same liquid command with the same pipette and location
+    return a.kind == kind and b.kind == kind and a.pipette == b.pipette and \
+        a.rate == b.rate and _samePoint(a, b)
+
+
+# _roundTrip(plan, i, ref)
+# plan[i] aspirates and plan[i + 1] dispenses the same volume at the same
+# location, matching ref (plan[i] by default)
+def _roundTrip(plan, i, ref=None):
+    if i + 1 >= len(plan):
+        return False
+    a, d = plan[i], plan[i + 1]
+    ref = ref or a
+    return a.kind == 'aspirate' and d.kind == 'dispense' and a.pipette == ref.pipette and \
+        d.pipette == ref.pipette and a.volume == ref.volume and d.volume == ref.volume and \
+        _samePoint(ref, a) and _samePoint(ref, d)
+
+
+# _pass(plan, counts, inMix)
+# One sweep of every rule over plan, returns the rewritten plan. inMix holds
+# the ids of the commands that were part of a mix() in the trace
+def _pass(plan, counts, inMix):
+    out = []
+    last = None  # last located command, both mounts share the gantry
+    i = 0
+    while i < len(plan):
+        cmd = plan[i]
+        nxt = plan[i + 1] if i + 1 < len(plan) else None
+
+        if cmd.kind == 'move_to':
+            if last is not None and last.pipette == cmd.pipette and _samePoint(last, cmd):
+                counts['noop_move'] += 1
+                i += 1
+                continue
+            if not waypoint(cmd) and nxt is not None and nxt.pipette == cmd.pipette and \
+                    nxt.point() is not None and \
+                    (nxt.kind == 'move_to' or _samePoint(cmd, nxt)):
+                # The next command takes the head there itself
+                counts['merged_move'] += 1
+                i += 1
+                continue
+
+        if nxt is not None and (_liquid(cmd, nxt, 'aspirate') or _liquid(cmd, nxt, 'dispense')):
+            counts['fused_liquid'] += 1
+            plan[i + 1] = replace(nxt, volume=cmd.volume + nxt.volume,
+                                  text='%s (fused)' % nxt.text)
+            i += 1
+            continue
+
+        # Round trips at one location: aspirate v, dispense v, repeated
+        reps = 0
+        while _roundTrip(plan, i + 2 * reps, cmd):
+            reps += 1
+        if reps > 0:
+            counts['fused_mix'] += sum(1 for r in range(reps) if id(plan[i + 2 * r]) not in inMix)
+            cmd = replace(cmd, kind='mix', reps=reps,
+                          text='Mixing %d times with a volume of %s ul' % (reps, cmd.volume))
+            out.append(cmd)
+            last = cmd
+            i += 2 * reps
+            continue
+
+        out.append(cmd)
+        if cmd.point() is not None and cmd.pipette:
+            last = cmd
+        i += 1
+    return out
+
+
+# peephole(trace)
+# Returns (optimized plan, report dict). The plan is flat: every command is
+# at level 0 and compound parents are gone
+def peephole(trace):
+    plan = []
+    inMix = set()
+    mixes = set()
+    parents = {}
+    for i, c in enumerate(trace):
+        parents[c.level] = c
+        if i + 1 < len(trace) and trace[i + 1].level > c.level:
+            continue
+        flat = replace(c, level=0)
+        if c.level > 0 and parents[c.level - 1].kind == 'mix':
+            inMix.add(id(flat))
+            mixes.add(id(parents[c.level - 1]))
+        plan.append(flat)
+    counts = dict.fromkeys(RULES, 0)
+    while True:
+        before = (sum(counts.values()), len(plan))
+        plan = _pass(plan, counts, inMix)
+        if (sum(counts.values()), len(plan)) == before:
+            break
+
+    xy0, z0 = travel([replace(c, level=0) for c in leaves(trace)])
+    xy1, z1 = travel(plan)
+    report = dict(counts)
+    # A mix() already is one command
+    report['commands_before'] = len(leaves(trace)) - len(inMix) + len(mixes)
+    report['commands_after'] = len(plan)
+    report['xy_removed_mm'] = xy0 - xy1
+    report['z_removed_mm'] = z0 - z1
+    return plan, report
+
+
+def printReport(report, name=''):
+    print('Peephole report %s' % name)
+    print('  commands: %d -> %d' % (report['commands_before'], report['commands_after']))
+    for rule in RULES:
+        print('  %-16s %d' % (rule, report[rule]))
+    print('  travel removed: %.1f mm XY, %.1f mm Z' % (
+        report['xy_removed_mm'], report['z_removed_mm']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Remove redundant motions from a protocol command plan')
+    parser.add_argument('protocol', help='protocol .py file, or a saved .jsonl trace')
+    parser.add_argument('-o', '--out', help='write the optimized plan here as .jsonl')
+    args = parser.parse_args()
+
+    if args.protocol.endswith('.jsonl'):
+        trace = loadTrace(args.protocol)
+    else:
+        trace, _ = cachedTrace(args.protocol)
+    plan, report = peephole(trace)
+    printReport(report, args.protocol)
+    if args.out:
+        saveTrace(plan, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,619 @@
+import argparse
+import ast
+import dataclasses
+import os
+import time
+from dataclasses import dataclass, field
+
+from timing import FITTED_MODEL, MARKER_KINDS, TOLERANCE, durations, loadModel
+
+# Incremental re-planning of assay spec edits
+# A simulated run is split into steps keyed by their inputs: the pipette,
+# the well it aspirates from, the wells it fills, the volume, the tips it
+# picks up and the delays. Edits to the literal assay spec of a protocol are
+# mapped onto those steps, and only the steps they touch are planned again:
+#
+#   well descriptor   e.g. 'D1 E+ S- rep1' -> 'D1 E- S- rep1' in rxnWells.
+#                     Transfers into the well switch to the source the new
+#                     token draws from (learned from the run: E+ lysate,
+#                     E- lysis buffer) and the tip changes of that phase are
+#                     laid out again by the change-tip-on-content-switch
+#                     rule the run follows
+#   delayTimes[i]     the delay step bound to the entry gets its new length
+#   timePoints[i]     the @tp marker bound to the entry gets its new due time
+#
+# Start times are carried forward from the first changed step only, and
+# only the timepoints whose sampling window reaches it are checked again.
+# Any other code edit needs a full simulation, which the CLI falls back to.
+#
+#   python replan.py ../10TP-Quench-C3993.py --rev HEAD      edits since HEAD
+#   python replan.py ../10TP-Quench-C3993.py --watch         re-plan on every save
+#   python replan.py ../10TP-Quench-C3993.py --verify        check against a full simulation
+
+# GLOBAL VARIABLE DEFINITION
+
+STEP_KINDS = {'pick_up_tip': 'pick', 'drop_tip': 'drop', 'return_tip': 'drop',
+              'delay': 'delay', 'pause': 'pause', 'comment': 'comment'}
+# Commands that finish the liquid step of the aspirate before them
+FOLLOW_KINDS = ('dispense', 'blow_out', 'touch_tip', 'air_gap', 'move_to')
+DUE_MATCH = 0.05        # s, @tp markers print due times to 0.1 s
+WATCH_POLL = 0.5        # s between checks of the protocol file
+VERIFY_TIME = 2.0       # s a re-planned run time may differ from a full simulation
+
+
+class ReplanError(Exception):
+    pass
+
+
+@dataclass
+class StepDef:
+    # Dataclass for one step of a plan: a liquid move from an aspirate up to
+    # the next command of another kind, a tip pick up or drop, a delay, a
+    # pause or a comment
+    kind: str               # liquid, pick, drop, delay, pause, comment or other
+    pipette: str = ''
+    src: str = ''           # 'slot:well' aspirated from
+    dests: tuple = ()       # 'slot:well' dispensed into
+    volume: float = 0.0     # uL aspirated
+    cost: float = 0.0       # s, with the moves into the step
+    sampled: float = 0.0    # s into the step when its aspirate ends
+    seconds: float = 0.0    # delays
+    message: str = ''       # pauses and comments
+
+    def key(self):
+        return (self.kind, self.pipette, self.src, self.dests, self.volume)
+
+
+@dataclass
+class PlanDef:
+    # Dataclass for a plan and the spec it was built from
+    steps: list
+    clock: list             # start of every step, s
+    wells: dict             # (list name, index) -> ['slot:well', descriptor]
+    numbers: dict           # bound list name -> values
+    bound: dict             # bound list name -> the step each entry sets
+    skeleton: str           # AST dump with the bound literals blanked
+    drivers: dict           # descriptor token -> source well it draws from
+    costs: dict             # step key -> (cost, sampled) as simulated
+    tipSteps: dict          # pipette -> (drop, pick) as simulated
+    checks: dict = field(default_factory=dict)  # (tag, tp) -> timepoint result
+
+
+# buildSteps(trace, model)
+# The leaf commands of trace grouped into StepDef
+def buildSteps(trace, model=None):
+    steps = []
+    cur = None
+    for cmd, t in durations(trace, model):
+        here = '%s:%s' % (cmd.slot, cmd.well) if cmd.well else ''
+        if cur is not None and cmd.pipette == cur.pipette and cmd.kind in FOLLOW_KINDS:
+            cur.cost += t
+            if cmd.kind == 'dispense':
+                cur.dests += (here,)
+            continue
+        cur = None
+        if cmd.kind == 'aspirate':
+            cur = StepDef('liquid', cmd.pipette, here, volume=cmd.volume, cost=t, sampled=t)
+            steps.append(cur)
+        else:
+            steps.append(StepDef(STEP_KINDS.get(cmd.kind, 'other'), cmd.pipette, cost=t,
+                                 seconds=cmd.seconds, message=cmd.message))
+    return steps
+
+
+def _assigns(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target = node.targets[0]
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            target = node.target
+        else:
+            continue
+        if isinstance(target, ast.Name):
+            yield target.id, node
+
+
+def _number(node):
+    return isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and \
+        not isinstance(node.value, bool)
+
+
+def _descriptor(node, slots):
+    return isinstance(node, ast.Tuple) and len(node.elts) >= 2 and \
+        isinstance(node.elts[0], ast.Name) and node.elts[0].id in slots and \
+        isinstance(node.elts[-1], ast.Constant) and isinstance(node.elts[-1].value, str) and \
+        node.elts[-1].value.split()
+
+
+# readSpec(source)
+# Literal assay spec of a protocol: numeric lists as {name: values}, and
+# well descriptors from lists of (labware, well, 'descriptor') tuples as
+# {(list name, index): ['slot:well', descriptor]}. The well is the first
+# token of the descriptor, the slot the one its labware is loaded into
+def readSpec(source):
+    tree = ast.parse(source)
+    slots = {}
+    for name, node in _assigns(tree):
+        call = node.value
+        if isinstance(call, ast.Call) and getattr(call.func, 'attr', '') == 'load_labware' and \
+                len(call.args) >= 2 and isinstance(call.args[1], ast.Constant):
+            slots[name] = str(call.args[1].value)
+    numbers = {}
+    wells = {}
+    for name, node in _assigns(tree):
+        elts = node.value.elts if isinstance(node.value, ast.List) else []
+        if elts and all(_number(e) for e in elts):
+            numbers[name] = [float(e.value) for e in elts]
+        elif elts and all(_descriptor(e, slots) for e in elts):
+            for i, e in enumerate(elts):
+                desc = e.elts[-1].value
+                wells[(name, i)] = ['%s:%s' % (slots[e.elts[0].id], desc.split()[0]), desc]
+    return numbers, wells
+
+
+# _skeleton(source, numbers, descs)
+# AST dump of source with the numeric lists named in numbers and the
+# descriptors of the lists named in descs blanked, so that two sources with
+# the same skeleton differ only in edits the planner handles
+def _skeleton(source, numbers, descs):
+    tree = ast.parse(source)
+    for name, node in _assigns(tree):
+        if name in numbers:
+            node.value = ast.Constant(None)
+        elif name in descs and isinstance(node.value, ast.List):
+            for e in node.value.elts:
+                if isinstance(e, ast.Tuple) and e.elts:
+                    e.elts[-1] = ast.Constant(None)
+    return ast.dump(tree, include_attributes=False)
+
+
+def _marker(step):
+    parts = step.message.split() if step.kind == 'comment' else []
+    return parts if parts[:1] and parts[0] in MARKER_KINDS else None
+
+
+# _bind(steps, values)
+# The steps a numeric list sets, in order: delays of its lengths, or @tp
+# markers of its due times. None when the list matches neither
+def _bind(steps, values):
+    delays = [s for s in steps if s.kind == 'delay']
+    markers = [s for s in steps if (_marker(s) or [''])[0] == '@tp']
+    for cands, match in ((delays, lambda s, v: abs(s.seconds - v) < 1e-6),
+                         (markers, lambda s, v: abs(float(s.message.split()[3]) - v) < DUE_MATCH)):
+        out = []
+        for s in cands:
+            if len(out) < len(values) and match(s, values[len(out)]):
+                out.append(s)
+        if len(out) == len(values):
+            return out
+    return None
+
+
+# drivers(steps, wells)
+# Descriptor token -> source well, for tokens with one source that fills
+# only wells with the token. Only single channel transfers into single
+# descriptor wells from outside them count, and sources that fill every
+# such well, like a buffer common to all, follow no token
+def drivers(steps, wells):
+    desc = dict(wells.values())
+    fills = {}
+    for s in steps:
+        if s.kind == 'liquid' and 'multi' not in s.pipette and len(s.dests) == 1 and \
+                s.dests[0] in desc and s.src not in desc:
+            fills.setdefault(s.src, set()).add(s.dests[0])
+    filled = set().union(*fills.values())
+    out = {}
+    for token in {t for d in desc.values() for t in d.split()[1:]}:
+        carry = {w for w, d in desc.items() if token in d.split()[1:]}
+        sources = [src for src, dests in fills.items() if dests != filled and dests <= carry]
+        if len(sources) == 1:
+            out[token] = sources[0]
+    return out
+
+
+# buildPlan(trace, source, model)
+# Plan of a simulated run of the protocol source
+def buildPlan(trace, source, model=None):
+    steps = buildSteps(trace, model)
+    numbers, wells = readSpec(source)
+    bound = {}
+    for name, values in numbers.items():
+        found = _bind(steps, values)
+        if found:
+            bound[name] = found
+    costs = {}
+    tipSteps = {}
+    for s in steps:
+        costs.setdefault(s.key(), (s.cost, s.sampled))
+        if s.kind in ('pick', 'drop'):
+            pair = tipSteps.setdefault(s.pipette, [None, None])
+            idx = 0 if s.kind == 'drop' else 1
+            if pair[idx] is None:
+                pair[idx] = s
+    plan = PlanDef(steps, [0.0] * len(steps), wells, {n: numbers[n] for n in bound}, bound,
+                   _skeleton(source, bound, {name for name, _ in wells}),
+                   drivers(steps, wells), costs, tipSteps)
+    update(plan, 0)
+    return plan
+
+
+# specEdits(plan, source)
+# Edits from the spec of plan to the protocol source, as ('number', name,
+# index, value) and ('well', (list name, index), descriptor). None when
+# source differs in anything else
+def specEdits(plan, source):
+    numbers, wells = readSpec(source)
+    if _skeleton(source, plan.bound, {name for name, _ in plan.wells}) != plan.skeleton or \
+            set(wells) != set(plan.wells):
+        return None
+    edits = []
+    for name, old in plan.numbers.items():
+        new = numbers.get(name)
+        if new is None or len(new) != len(old):
+            return None
+        edits += [('number', name, i, b) for i, (a, b) in enumerate(zip(old, new)) if a != b]
+    for key, (_, desc) in sorted(wells.items()):
+        if desc != plan.wells[key][1]:
+            edits.append(('well', key, desc))
+    return edits
+
+
+def _lookup(plan, step):
+    if step.key() in plan.costs:
+        return plan.costs[step.key()]
+    # Same draw into another well: the move into the destination differs
+    # little next to the draw
+    for key, found in plan.costs.items():
+        if key[0] == 'liquid' and key[1:3] == (step.pipette, step.src) and key[4] == step.volume:
+            return found
+    raise ReplanError('no simulated step draws %.1f uL from %s with %s' % (
+        step.volume, step.src, step.pipette))
+
+
+# _phase(plan, i)
+# Bounds [lo, hi) of the run of liquid steps around step i that draw from
+# descriptor driven sources with one pipette, with the tip changes between
+def _phase(plan, i):
+    steps = plan.steps
+    pipette = steps[i].pipette
+    sources = set(plan.drivers.values())
+
+    def inPhase(s):
+        return s.pipette == pipette and (
+            s.kind in ('pick', 'drop') or s.kind == 'liquid' and s.src in sources)
+
+    lo, hi = i, i + 1
+    while lo > 0 and inPhase(steps[lo - 1]):
+        lo -= 1
+    while hi < len(steps) and inPhase(steps[hi]):
+        hi += 1
+    while steps[lo].kind != 'liquid':
+        lo += 1
+    while steps[hi - 1].kind != 'liquid':
+        hi -= 1
+    return lo, hi
+
+
+# _followsSwitchRule(steps)
+# Whether a phase changes tips exactly between draws from different sources
+def _followsSwitchRule(steps):
+    last = None
+    between = []
+    for s in steps:
+        if s.kind != 'liquid':
+            between.append(s.kind)
+            continue
+        if last is not None and between != (['drop', 'pick'] if s.src != last.src else []):
+            return False
+        last = s
+        between = []
+    return True
+
+
+# setDescriptor(plan, key, desc)
+# Apply a well descriptor edit. Returns the first step it changes
+def setDescriptor(plan, key, desc):
+    well, old = plan.wells[key]
+    known = set()
+    for _, d in plan.wells.values():
+        known.update(d.split()[1:])
+    new = set(desc.split()[1:])
+    if new - known:
+        raise ReplanError('%s: token %s is in no simulated descriptor' % (
+            well, ' '.join(sorted(new - known))))
+    plan.wells[key][1] = desc
+    targets = {src for token, src in plan.drivers.items() if token in new}
+    bySource = {}
+    for token, src in plan.drivers.items():
+        bySource.setdefault(src, set()).add(token)
+    changed = [s for s in plan.steps if s.kind == 'liquid' and s.dests == (well,)
+               and s.src in bySource and not bySource[s.src] & new]
+    if not changed:
+        # The run may still read the descriptor in a way the plan does not
+        # know of, only a full simulation can tell
+        raise ReplanError('%s: %r changes no transfer the plan knows of' % (well, desc))
+    if len(targets) != 1:
+        raise ReplanError('%s: %r draws from %d sources' % (well, desc, len(targets)))
+
+    phases = []
+    for s in changed:
+        bounds = _phase(plan, plan.steps.index(s))
+        if not _followsSwitchRule(plan.steps[bounds[0]:bounds[1]]):
+            raise ReplanError('%s: tip changes around its transfer follow no content switch' % well)
+        if bounds not in phases:
+            phases.append(bounds)
+    src = targets.pop()
+    for s in changed:
+        s.src = src
+        s.cost, s.sampled = _lookup(plan, s)
+
+    # Lay the tips of each phase out again, last phase first so the bounds
+    # of the earlier ones hold. New tip changes cost what the phase's own
+    # did, the run's first ones when it had none
+    for lo, hi in sorted(phases, reverse=True):
+        own = {s.kind: s for s in plan.steps[lo:hi] if s.kind in ('pick', 'drop')}
+        laid = []
+        last = None
+        for s in plan.steps[lo:hi]:
+            if s.kind != 'liquid':
+                continue
+            if last is not None and s.src != last.src:
+                drop, pick = plan.tipSteps.get(s.pipette, (None, None))
+                drop, pick = own.get('drop', drop), own.get('pick', pick)
+                if drop is None or pick is None:
+                    raise ReplanError('%s never changes tips in the simulated run' % s.pipette)
+                laid += [dataclasses.replace(drop), dataclasses.replace(pick)]
+            laid.append(s)
+            last = s
+        plan.steps[lo:hi] = laid
+        plan.clock[lo:hi] = [0.0] * len(laid)
+    return min(lo for lo, _ in phases)
+
+
+# applyEdit(plan, edit)
+# Apply one edit from specEdits(). Returns the first step it changes
+def applyEdit(plan, edit):
+    if edit[0] == 'well':
+        return setDescriptor(plan, edit[1], edit[2])
+    _, name, i, value = edit
+    plan.numbers[name][i] = value
+    step = plan.bound[name][i]
+    if step.kind == 'delay':
+        step.seconds = step.cost = value
+    else:
+        parts = step.message.split()
+        parts[3] = '%.1f' % value
+        step.message = ' '.join(parts)
+    return plan.steps.index(step)
+
+
+# _windowEnd(plan, m)
+# End of the sampling window of the timepoint whose marker is step m: the
+# next delay, pause or marker, the window is steps m + 1 up to it
+def _windowEnd(plan, m):
+    for j in range(m + 1, len(plan.steps)):
+        s = plan.steps[j]
+        if s.kind in ('delay', 'pause') or _marker(s) is not None:
+            return j
+    return len(plan.steps)
+
+
+# _checkTimepoint(plan, m, t0)
+# Sampling time, cycle and lateness of the timepoint whose marker is step m
+def _checkTimepoint(plan, m, t0):
+    parts = plan.steps[m].message.split()
+    out = {'tag': parts[1], 'tp': int(parts[2]), 'due': float(parts[3]),
+           'at': None, 'cycle': 0.0, 'late': None}
+    for j in range(m + 1, _windowEnd(plan, m)):
+        s = plan.steps[j]
+        if s.kind == 'liquid' and out['at'] is None:
+            out['at'] = plan.clock[j] + s.sampled
+        out['cycle'] += s.cost
+    if t0 is not None and out['at'] is not None:
+        out['at'] -= plan.clock[t0]
+        out['late'] = out['at'] - out['due']
+    return out
+
+
+# update(plan, dirty)
+# Carry start times forward from step dirty and check again the timepoints
+# whose marker, sampling window or @t0 reaches it
+def update(plan, dirty):
+    steps = plan.steps
+    clock = plan.clock
+    for j in range(max(dirty, 1), len(steps)):
+        clock[j] = clock[j - 1] + steps[j - 1].cost
+    t0 = {}
+    seen = set()
+    for i, s in enumerate(steps):
+        parts = _marker(s)
+        if parts is None:
+            continue
+        if parts[0] == '@t0':
+            t0[parts[1]] = i
+            continue
+        key = (parts[1], int(parts[2]))
+        seen.add(key)
+        if key in plan.checks and _windowEnd(plan, i) <= dirty and t0.get(parts[1], -1) < dirty:
+            continue
+        plan.checks[key] = _checkTimepoint(plan, i, t0.get(parts[1]))
+    for key in set(plan.checks) - seen:
+        del plan.checks[key]
+
+
+# failures(plan, tolerance)
+# Messages for timepoints that are sampled early or late or spaced closer
+# than their sampling cycle, as timing.checkSchedule() reports them
+def failures(plan, tolerance=TOLERANCE):
+    out = []
+    byTag = {}
+    for (tag, _), tp in sorted(plan.checks.items()):
+        byTag.setdefault(tag, []).append(tp)
+        if tp['late'] is None:
+            out.append('%s timepoint %d: no @t0 marker or no aspirate after its marker' % (
+                tag, tp['tp']))
+        elif abs(tp['late']) > tolerance:
+            out.append('%s timepoint %d due at %.1f s is sampled at %.1f s (%.1f s %s)' % (
+                tag, tp['tp'], tp['due'], tp['at'], abs(tp['late']),
+                'late' if tp['late'] > 0 else 'early'))
+    for tag, seq in byTag.items():
+        for a, b in zip(seq, seq[1:]):
+            if b['due'] - a['due'] < a['cycle']:
+                out.append('%s timepoints %d-%d are %.1f s apart, the sampling cycle takes %.1f s' % (
+                    tag, a['tp'], b['tp'], b['due'] - a['due'], a['cycle']))
+    return out
+
+
+# estimates(plan)
+# Run time in s and tip pick-ups as {window: {mount: pick-ups}}, split at
+# the @window markers like tipsched.segments()
+def estimates(plan):
+    windows = {'start': {}}
+    cur = windows['start']
+    for s in plan.steps:
+        if s.kind == 'comment' and s.message.split()[:1] == ['@window']:
+            cur = windows.setdefault(s.message.split()[1], {})
+        elif s.kind == 'pick':
+            mount = s.pipette.split('@')[-1]
+            cur[mount] = cur.get(mount, 0) + 1
+    total = plan.clock[-1] + plan.steps[-1].cost if plan.steps else 0.0
+    return total, windows
+
+
+# replan(plan, edits)
+# Apply edits and re-plan from the first step they change. Returns that
+# step, None when no step changed
+def replan(plan, edits):
+    dirty = None
+    for edit in edits:
+        first = applyEdit(plan, edit)
+        if first is not None:
+            dirty = first if dirty is None else min(dirty, first)
+    if dirty is not None:
+        update(plan, dirty)
+    return dirty
+
+
+# verify(plan, full, tolerance)
+# Where plan differs from full, the plan of a full simulation of the same
+# edited protocol: run time by more than tolerance, tip pick-ups per window
+# and the timepoints that fail
+def verify(plan, full, tolerance=VERIFY_TIME):
+    out = []
+    total, windows = estimates(plan)
+    fullTotal, fullWindows = estimates(full)
+    if abs(total - fullTotal) > tolerance:
+        out.append('run time %.1f s re-planned, %.1f s simulated' % (total, fullTotal))
+    if windows != fullWindows:
+        out.append('tip pick-ups %r re-planned, %r simulated' % (windows, fullWindows))
+    msgs, fullMsgs = set(failures(plan)), set(failures(full))
+    for msg in sorted(msgs - fullMsgs):
+        out.append('re-planned only: %s' % msg)
+    for msg in sorted(fullMsgs - msgs):
+        out.append('simulated only: %s' % msg)
+    return out
+
+
+def _tips(windows):
+    out = {}
+    for demand in windows.values():
+        for mount, n in demand.items():
+            out[mount] = out.get(mount, 0) + n
+    return out
+
+
+def _describe(plan, edit):
+    if edit[0] == 'well':
+        return '%s[%d] %s -> %r' % (edit[1][0], edit[1][1], plan.wells[edit[1]][0], edit[2])
+    return '%s[%d] -> %g' % (edit[1], edit[2], edit[3])
+
+
+def printEstimates(plan, before, tolerance):
+    total, windows = estimates(plan)
+    tips = _tips(windows)
+    oldTotal, oldTips = before
+    print('Estimated run time: %.0f s (%+.1f s)' % (total, total - oldTotal))
+    print('Tip pick-ups: %s' % ', '.join('%s %d (%+d)' % (m, n, n - oldTips.get(m, 0))
+                                         for m, n in sorted(tips.items())))
+    print('tipDemand = %r' % {w: d for w, d in windows.items() if w != 'start'})
+    msgs = failures(plan, tolerance)
+    for msg in msgs:
+        print('FAIL:', msg)
+    if not msgs:
+        print('All timepoints can be met')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Re-plan only the steps an assay spec edit touches')
+    parser.add_argument('protocol', help='edited protocol .py file')
+    parser.add_argument('--rev', default='HEAD', help='git revision the edits are made against')
+    parser.add_argument('--base', help='protocol .py file the edits are made against, instead of --rev')
+    parser.add_argument('--durations', default=FITTED_MODEL,
+                        help='JSON file of measured command costs, the fitted OT-2 costs by default')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='seconds a timepoint may be late')
+    parser.add_argument('--watch', action='store_true', help='re-plan every time the file is saved')
+    parser.add_argument('--verify', action='store_true',
+                        help='check every re-plan against a full simulation of the edited file')
+    args = parser.parse_args()
+
+    from simcache import cachedTrace
+    if args.base:
+        base = args.base
+    else:
+        from tracediff import gitVersion
+        base = gitVersion(args.protocol, args.rev)
+    model = loadModel(args.durations)
+    with open(base) as f:
+        source = f.read()
+    trace, _ = cachedTrace(base)
+    plan = buildPlan(trace, source, model)
+    print('%d steps, %d bound spec lists (%s), %d well descriptors' % (
+        len(plan.steps), len(plan.bound), ', '.join(sorted(plan.bound)), len(plan.wells)))
+
+    stamp = None
+    while True:
+        mtime = os.stat(args.protocol).st_mtime
+        if mtime != stamp:
+            stamp = mtime
+            with open(args.protocol) as f:
+                source = f.read()
+            total, windows = estimates(plan)
+            before = (total, _tips(windows))
+            start = time.perf_counter()
+            edits = specEdits(plan, source)
+            try:
+                dirty = replan(plan, edits) if edits is not None else None
+            except ReplanError as e:
+                print('Cannot re-plan: %s' % e)
+                edits = None
+            took = (time.perf_counter() - start) * 1000
+            if edits is None:
+                print('Code changed beyond the assay spec, simulating again')
+                trace, summary = cachedTrace(args.protocol)
+                plan = buildPlan(trace, source, model)
+                print('Simulated%s' % (' (cached)' if summary['cached'] else ''))
+            elif edits:
+                for edit in edits:
+                    print('Edit:', _describe(plan, edit))
+                print('Re-planned from step %s of %d in %.2f ms' % (
+                    '-' if dirty is None else dirty, len(plan.steps), took))
+            printEstimates(plan, before, args.tolerance)
+            if args.verify and edits:
+                trace, _ = cachedTrace(args.protocol)
+                diffs = verify(plan, buildPlan(trace, source, model))
+                for msg in diffs:
+                    print('MISMATCH:', msg)
+                if not diffs:
+                    print('Re-plan matches a full simulation')
+        if not args.watch:
+            break
+        try:
+            time.sleep(WATCH_POLL)
+        except KeyboardInterrupt:
+            break
+
+
+if __name__ == '__main__':
+    main()
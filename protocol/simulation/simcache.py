@@ -0,0 +1,214 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import asdict
+
+from cmdtrace import LABWARE_DIR, Cmd, simulateTrace
+from timing import estimate
+
+# Content-hashed cache of simulation results
+# A protocol is simulated again only when its code changes, not when a
+# comment or the formatting does. The key hashes the protocol's normalized
+# AST, the custom labware definitions it loads, its API level, the
+# installed opentrons version and the code of the tools that write the
+# entries. Each entry keeps the command trace, tip usage and timing estimate
+# in one JSON file; the least recently used entries are evicted when the
+# cache grows over its size cap.
+#
+#   trace, summary = cachedTrace('../10TP-Quench-C3993.py')
+#   python simcache.py ../*.py          simulate a batch, reusing the cache
+
+# GLOBAL VARIABLE DEFINITION
+
+CACHE_DIR = os.environ.get('OTLIB_SIMCACHE', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.simcache'))
+CACHE_CAP = 200 * 1024 * 1024  # bytes on disk before LRU eviction
+# Modules whose code shapes a cache entry: the Cmd schema and run log
+# parsing, and the timing model of the summary
+TOOL_MODULES = ['cmdtrace.py', 'timing.py']
+
+
+# _normalizedAst(source)
+# AST dump without line numbers, comments or docstrings
+def _normalizedAst(source):
+    tree = ast.parse(source)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            body = node.body
+            if body and isinstance(body[0], ast.Expr) and isinstance(
+                    getattr(body[0], 'value', None), ast.Constant) and isinstance(body[0].value.value, str):
+                node.body = body[1:] or [ast.Pass()]
+    return tree, ast.dump(tree, include_attributes=False)
+
+
+# _customLabware()
+# load name -> definition file for the labware in the repo
+def _customLabware():
+    found = {}
+    for root, dirs, files in os.walk(LABWARE_DIR):
+        for name in files:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                with open(path) as f:
+                    loadName = json.load(f)['parameters']['loadName']
+            except (ValueError, KeyError):
+                continue
+            found[loadName] = path
+    return found
+
+
+def _apiLevel(tree):
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                getattr(t, 'id', '') == 'metadata' for t in node.targets):
+            try:
+                return ast.literal_eval(node.value).get('apiLevel', '')
+            except ValueError:
+                return ''
+    return ''
+
+
+def _opentronsVersion():
+    try:
+        import opentrons
+        return opentrons.__version__
+    except ImportError:
+        return ''
+
+
+# _toolingHash()
+# Hash of the tool modules that write the entries, so a change to them
+# leaves the old entries unused until they are evicted
+def _toolingHash():
+    h = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in TOOL_MODULES:
+        with open(os.path.join(here, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# protocolKey(path)
+# Content hash identifying everything that can change a simulation of path
+def protocolKey(path):
+    with open(path) as f:
+        tree, dump = _normalizedAst(f.read())
+    h = hashlib.sha256()
+    h.update(dump.encode())
+    h.update(_apiLevel(tree).encode())
+    h.update(_opentronsVersion().encode())
+    h.update(_toolingHash().encode())
+
+    # Custom labware the protocol names anywhere in its code
+    custom = _customLabware()
+    names = sorted({node.value for node in ast.walk(tree)
+                    if isinstance(node, ast.Constant) and node.value in custom})
+    for name in names:
+        with open(custom[name], 'rb') as f:
+            h.update(name.encode())
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# summarize(trace)
+# Tip usage per pipette, command count and timing estimate of a trace
+def summarize(trace):
+    tips = {}
+    for cmd in trace:
+        if cmd.kind == 'pick_up_tip':
+            tips[cmd.pipette] = tips.get(cmd.pipette, 0) + 1
+    return {'commands': len(trace), 'tips': tips, 'estimate_s': estimate(trace)}
+
+
+def _entryPath(key):
+    return os.path.join(CACHE_DIR, key + '.json')
+
+
+# evict(cap)
+# Remove least recently used entries until the cache fits in cap bytes
+def evict(cap=CACHE_CAP):
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        # Entries other processes are still writing are theirs
+        if name.endswith('.tmp'):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= cap:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# cachedTrace(path, cap)
+# Command trace and summary of the protocol at path, simulated only on a
+# cache miss. Returns (trace, summary); summary['cached'] tells which
+def cachedTrace(path, cap=CACHE_CAP):
+    key = protocolKey(path)
+    entry = _entryPath(key)
+    if os.path.exists(entry):
+        with open(entry) as f:
+            data = json.load(f)
+        # A hit counts as a use for LRU eviction
+        os.utime(entry)
+        summary = data['summary']
+        summary['cached'] = True
+        return [Cmd(**c) for c in data['trace']], summary
+
+    trace = simulateTrace(path)
+    summary = summarize(trace)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # A temporary file of its own, so concurrent runs never write into the
+    # same one, and the entry appears whole
+    with tempfile.NamedTemporaryFile('w', dir=CACHE_DIR, suffix='.tmp', delete=False) as f:
+        json.dump({'protocol': os.path.basename(path), 'summary': summary,
+                   'trace': [asdict(c) for c in trace]}, f)
+    os.replace(f.name, entry)
+    evict(cap)
+    summary['cached'] = False
+    return trace, summary
+
+
+def clear():
+    if os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate protocols, reusing cached results of unchanged ones')
+    parser.add_argument('protocols', nargs='*', help='protocol .py files')
+    parser.add_argument('--cap', type=int, default=CACHE_CAP // (1024 * 1024),
+                        help='cache size cap in MB')
+    parser.add_argument('--clear', action='store_true', help='empty the cache first')
+    args = parser.parse_args()
+
+    if args.clear:
+        clear()
+    for path in args.protocols:
+        trace, summary = cachedTrace(path, args.cap * 1024 * 1024)
+        tips = ', '.join('%s: %d' % t for t in sorted(summary['tips'].items()))
+        print('%-40s %6d commands  %7.0f s  tips %s%s' % (
+            os.path.basename(path), summary['commands'], summary['estimate_s'],
+            tips or 'none', '  (cached)' if summary['cached'] else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import select
+import socket
+import sys
+import time
+
+# Live run telemetry collector
+# Receives the JSON datagrams the protocols send with tele() and shows one
+# line per robot and protocol: current step, lag of the last timepoint
+# against its schedule, tips used and commands per minute. Robots that stop
+# reporting are flagged as stalled.
+#
+#   python telemetry.py                     listen on UDP 9870
+#   python telemetry.py --log run.jsonl     also keep every record
+
+# GLOBAL VARIABLE DEFINITION
+
+DEFAULT_PORT = 9870
+STALL_AFTER = 90.0  # s without a record before a run counts as stalled
+REFRESH = 1.0       # s between dashboard redraws
+
+
+def render(runs, stallAfter, out=sys.stdout):
+    now = time.time()
+    lines = ['%-16s %-36s %-28s %8s %5s %6s %6s' % (
+        'robot', 'protocol', 'step', 'lag s', 'tips', 'cmd/m', 'age s')]
+    for key in sorted(runs):
+        rec, seen = runs[key]
+        age = now - seen
+        lag = rec.get('lag')
+        lines.append('%-16s %-36s %-28s %8s %5d %6.1f %6.0f%s' % (
+            rec.get('robot', '?')[:16], rec.get('protocol', '?')[:36], rec.get('step', '')[:28],
+            '%.1f' % lag if lag is not None else '-', rec.get('tips', 0),
+            rec.get('cpm', 0.0), age, '  STALLED' if age > stallAfter and rec.get('step') != 'complete' else ''))
+    # Clear the terminal and redraw from the top
+    out.write('\x1b[2J\x1b[H' + '\n'.join(lines) + '\n')
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect and show live protocol telemetry')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='UDP port to listen on')
+    parser.add_argument('--log', help='append every record to this .jsonl file')
+    parser.add_argument('--stall', type=float, default=STALL_AFTER,
+                        help='seconds of silence before a run is flagged as stalled')
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((args.host, args.port))
+    log = open(args.log, 'a') if args.log else None
+
+    # (robot, protocol) -> (last record, time received)
+    runs = {}
+    lastDraw = 0.0
+    try:
+        while True:
+            ready, _, _ = select.select([sock], [], [], REFRESH)
+            if ready:
+                data, addr = sock.recvfrom(65535)
+                try:
+                    rec = json.loads(data)
+                except ValueError:
+                    continue
+                rec.setdefault('robot', addr[0])
+                runs[(rec['robot'], rec.get('protocol', '?'))] = (rec, time.time())
+                if log:
+                    log.write(json.dumps(dict(rec, received=time.time())) + '\n')
+                    log.flush()
+            if time.time() - lastDraw >= REFRESH:
+                render(runs, args.stall)
+                lastDraw = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log:
+            log.close()
+
+
+if __name__ == '__main__':
+    main()
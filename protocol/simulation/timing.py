@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+from cmdtrace import deckTop, fromRunlog, leaves, loadTrace, moveCost
+
+# Static timing feasibility checker
+# Estimates when every command of a simulated run happens and checks the
+# timepoint schedule the protocol declares with comment markers:
+#
+#   protocol.comment('@t0 rxn')             reaction time zero is here
+#   protocol.comment('@tp rxn 3 180')       the next aspirate is timepoint 3,
+#                                           due 180 s after @t0 of rxn
+#
+# The run fails when a timepoint is sampled earlier or later than its due
+# time, or when two consecutive due times are closer than a sampling cycle
+# can ever be.
+#
+#   python timing.py ../10TP-Quench-C3993-Eco.py --durations ot2_fitted.json
+#
+# The protocols with timepoints also run the check themselves when they are
+# simulated, see watchRun(), and fail the simulation when it finds a
+# timepoint that can't be met.
+#
+# The default costs put one timepoint transfer (pick up, aspirate, dispense,
+# drop) at about 17 s, where the protocols' delays are tuned to the 24.7 s
+# it takes on our OT-2, with 60 s from the substrate dispense to the first
+# sample. ot2_fitted.json adds a plunger overhead to every aspirate and
+# dispense and raises the tip pick up and drop costs to match both; use it,
+# or measured costs, to check schedules
+
+# GLOBAL VARIABLE DEFINITION
+
+# Estimated command costs, in s unless noted. A --durations JSON file with
+# any of these keys replaces them with values measured on the robot
+DEFAULT_MODEL = {
+    'xy_speed': 400.0,      # mm/s, OT-2 default gantry speed
+    'z_speed': 125.0,       # mm/s
+    'move_overhead': 0.3,   # acceleration and settling per move
+    'flow_rate': 92.86,     # uL/s when the run log has no flow rate
+    'liquid_overhead': 0.0, # plunger start and settling per aspirate or dispense
+    'pick_up_tip': 4.0,
+    'drop_tip': 3.0,
+    'return_tip': 3.0,
+    'blow_out': 1.0,
+    'touch_tip': 2.0,
+    'air_gap': 1.0,
+    'home': 10.0,
+}
+
+FITTED_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ot2_fitted.json')
+FLOW_RE = re.compile(r'at ([0-9.]+) uL/sec')
+MARKER_KINDS = ('@t0', '@tp')
+# s a timepoint may be early or late before the run fails. The fitted costs
+# drift by up to about 0.2 s per sampling cycle as the aspirate heights
+# follow the liquid down, so a 10 timepoint run is good to about 2 s
+TOLERANCE = 2.5
+RUN_CHECK = True  # off in the tools here, they trace runs that fail it too
+RUN_WATCH = True  # off to run protocols as on the robot, without watchRun()
+
+
+def loadModel(path=None):
+    model = dict(DEFAULT_MODEL)
+    if path:
+        with open(path) as f:
+            model.update(json.load(f))
+    return model
+
+
+# durations(trace, model)
+# Estimated duration of every leaf command of trace, as a list of
+# (cmd, seconds). Pauses wait for the operator and count as zero
+def durations(trace, model=None):
+    model = model or DEFAULT_MODEL
+    top = deckTop(trace)
+    out = []
+    prev = None
+    for cmd in leaves(trace):
+        t = 0.0
+        if cmd.point() is not None:
+            if prev is not None:
+                xy, z = moveCost(prev, cmd, top)
+                if xy or z:
+                    t += xy / model['xy_speed'] + z / model['z_speed'] + model['move_overhead']
+            prev = cmd
+        if cmd.kind in ('aspirate', 'dispense'):
+            flow = FLOW_RE.search(cmd.text)
+            rate = float(flow.group(1)) if flow else model['flow_rate'] * cmd.rate
+            t += (cmd.volume / rate if rate else 0.0) + model['liquid_overhead']
+        elif cmd.kind == 'delay':
+            t += cmd.seconds
+        elif cmd.kind in model:
+            t += model[cmd.kind]
+        out.append((cmd, t))
+    return out
+
+
+# estimate(trace, model)
+# Estimated run time of trace in s, without operator pauses
+def estimate(trace, model=None):
+    return sum(t for _, t in durations(trace, model))
+
+
+def _marker(cmd):
+    if cmd.kind != 'comment':
+        return None
+    parts = cmd.message.split()
+    if not parts or parts[0] not in MARKER_KINDS:
+        return None
+    return parts
+
+
+# timepoints(trace, model)
+# Every declared timepoint as a dict with the sampling cycle that follows
+# its marker (up to the next delay, pause or marker)
+def timepoints(trace, model=None):
+    timed = durations(trace, model)
+    t0 = {}
+    tps = []
+    clock = 0.0
+    cur = None
+    for cmd, t in timed:
+        parts = _marker(cmd)
+        if parts is not None or cmd.kind in ('delay', 'pause'):
+            cur = None
+        if parts is not None and parts[0] == '@t0':
+            t0[parts[1]] = clock
+        elif parts is not None:
+            cur = {'tag': parts[1], 'tp': int(parts[2]), 'due': float(parts[3]),
+                   't0': t0.get(parts[1]), 'at': None, 'cycle': 0.0,
+                   'pipette': '', 'source': '', 'dest': ''}
+            tps.append(cur)
+        elif cur is not None:
+            cur['cycle'] += t
+            if cmd.kind == 'aspirate' and cur['at'] is None:
+                # Sample is taken when its aspirate ends
+                cur['at'] = clock + t
+                cur['pipette'] = cmd.pipette
+                cur['source'] = cmd.labware
+            elif cmd.kind == 'dispense' and not cur['dest']:
+                cur['dest'] = cmd.labware
+        clock += t
+    return tps
+
+
+# checkSchedule(trace, model, tolerance)
+# Returns (failures, spacing): a list of messages for deadlines that cannot
+# be met and the minimum achievable timepoint spacing in s for every
+# (pipette, source labware, destination labware) sampling combination
+def checkSchedule(trace, model=None, tolerance=TOLERANCE):
+    tps = timepoints(trace, model)
+    failures = []
+    spacing = {}
+    for tp in tps:
+        key = (tp['pipette'], tp['source'], tp['dest'])
+        spacing[key] = max(spacing.get(key, 0.0), tp['cycle'])
+        if tp['t0'] is None or tp['at'] is None:
+            failures.append('%s timepoint %d: no @t0 marker or no aspirate after its marker' % (
+                tp['tag'], tp['tp']))
+            continue
+        late = tp['at'] - tp['t0'] - tp['due']
+        tp['late'] = late
+        if abs(late) > tolerance:
+            failures.append('%s timepoint %d due at %.1f s is sampled at %.1f s (%.1f s %s)' % (
+                tp['tag'], tp['tp'], tp['due'], tp['at'] - tp['t0'], abs(late),
+                'late' if late > 0 else 'early'))
+
+    # Consecutive due times closer than a sampling cycle can never be met,
+    # whatever the delays are tuned to
+    byTag = {}
+    for tp in tps:
+        byTag.setdefault(tp['tag'], []).append(tp)
+    for tag, seq in byTag.items():
+        for a, b in zip(seq, seq[1:]):
+            if b['due'] - a['due'] < a['cycle']:
+                failures.append('%s timepoints %d-%d are %.1f s apart, the sampling cycle takes %.1f s' % (
+                    tag, a['tp'], b['tp'], b['due'] - a['due'], a['cycle']))
+    return failures, spacing
+
+
+# watchRun(protocol, durations, tolerance)
+# Record the commands of a simulated run from the broker of protocol, like
+# opentrons.simulate does for its run log. Returns (finish, clock): call
+# finish() at the end of run() to raise RuntimeError with the failures of
+# checkSchedule() unless RUN_CHECK is off; clock() is the modelled time in s
+# of the commands recorded so far, the simulated stand-in for a wall clock.
+# (None, None) when RUN_WATCH is off
+def watchRun(protocol, durations=FITTED_MODEL, tolerance=TOLERANCE):
+    if not RUN_WATCH:
+        return None, None
+    model = loadModel(durations)
+    runlog = []
+    depth = [0]
+
+    def record(message):
+        if message['$'] == 'before':
+            runlog.append({'level': depth[0], 'payload': message['payload']})
+            depth[0] += 1
+        else:
+            depth[0] = max(depth[0] - 1, 0)
+
+    unsubscribe = protocol.broker.subscribe('command', record)
+
+    def clock():
+        return estimate(fromRunlog(runlog), model)
+
+    def finish():
+        unsubscribe()
+        if not RUN_CHECK:
+            return
+        failures, _ = checkSchedule(fromRunlog(runlog), model, tolerance)
+        if failures:
+            raise RuntimeError('Timepoint schedule cannot be met:\n  ' + '\n  '.join(failures))
+
+    return finish, clock
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that a protocol can meet its timepoint schedule')
+    parser.add_argument('protocol', help='protocol .py file, or a saved .jsonl trace')
+    parser.add_argument('--durations', help='JSON file of measured command costs')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='seconds a timepoint may be early or late')
+    args = parser.parse_args()
+
+    if args.protocol.endswith('.jsonl'):
+        trace = loadTrace(args.protocol)
+    else:
+        # simcache imports this module for its estimates
+        from simcache import cachedTrace
+        trace, _ = cachedTrace(args.protocol)
+    model = loadModel(args.durations)
+    failures, spacing = checkSchedule(trace, model, args.tolerance)
+
+    print('Estimated run time: %.0f s' % estimate(trace, model))
+    print('Minimum timepoint spacing:')
+    for (pipette, source, dest), cycle in sorted(spacing.items()):
+        print('  %-24s %s -> %s: %.1f s' % (pipette, source, dest, cycle))
+    if failures:
+        for msg in failures:
+            print('FAIL:', msg)
+        sys.exit(1)
+    print('All timepoints can be met')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import argparse
+import ast
+import sys
+
+from cmdtrace import loadTrace
+from simcache import cachedTrace
+from timing import durations
+
+# Tip rack replenishment planner
+# Predicts from a simulated plan when the tip racks of each mount run dry
+# and which idle window should prompt the refill. Idle windows are marked
+# in the protocols by tipRefill() with
+#
+#   protocol.comment('@window <name>')
+#
+# ahead of an operator pause or a long delay. The planner prints the
+# tipWindows / tipDemand the protocol needs and the refill schedule for the
+# given starting tips, with refills batched into windows where the operator
+# is already at the robot. The tables in the protocols are copied from this
+# output and go stale when the plan changes; --check compares them with the
+# plan and exits with 1 when they differ.
+#
+#   python tipsched.py ../10TP-QuenchLong-C3993.py --start right=A8
+#   python tipsched.py ../10TP-QuenchLong-C3993.py --check
+
+# GLOBAL VARIABLE DEFINITION
+
+RACK_TIPS = 96
+ROWS = 'ABCDEFGH'
+
+
+def _mount(pipette):
+    return pipette.split('@')[-1]
+
+
+def _startIndex(well, multi):
+    # Pick-ups already used before the starting tip, column by column
+    col = int(well[1:]) - 1
+    row = ROWS.index(well[0])
+    return col if multi else col * len(ROWS) + row
+
+
+# segments(trace)
+# Split the plan at its idle windows. Returns a list of dicts with the
+# window name ('start' before the first window), whether the operator is
+# at the robot in that window and the pick-ups per mount until the next
+# window. Also returns the rack slots each mount picks tips from
+def segments(trace):
+    segs = [{'window': 'start', 'attended': True, 'demand': {}}]
+    racks = {}
+    timed = durations(trace)
+    for i, (cmd, _) in enumerate(timed):
+        parts = cmd.message.split() if cmd.kind == 'comment' else []
+        if parts[:1] == ['@window']:
+            # Attended when the next real command is an operator pause
+            nxt = next((c for c, _ in timed[i + 1:] if c.kind != 'comment'), None)
+            segs.append({'window': parts[1], 'attended': nxt is not None and nxt.kind == 'pause',
+                         'demand': {}})
+        elif cmd.kind == 'pick_up_tip':
+            mount = _mount(cmd.pipette)
+            demand = segs[-1]['demand']
+            demand[mount] = demand.get(mount, 0) + 1
+            racks.setdefault(mount, {'multi': 'multi' in cmd.pipette, 'slots': set()})
+            racks[mount]['slots'].add(cmd.slot)
+    return segs, racks
+
+
+# schedule(segs, racks, start)
+# Replay the windows with the same policy as tipRefill() in the protocols:
+# refill a mount when it can't cover its pick-ups until the next window, and
+# batch in mounts that would run dry before the end of the run when the
+# operator is at the robot anyway. Returns [(window, [mounts refilled])] and
+# the mounts whose pick-ups between two windows exceed full racks
+def schedule(segs, racks, start):
+    cap = {m: len(r['slots']) * (RACK_TIPS // len(ROWS) if r['multi'] else RACK_TIPS)
+           for m, r in racks.items()}
+    left = {m: cap[m] - _startIndex(start.get(m, 'A1'), racks[m]['multi']) for m in racks}
+    refills = []
+    overflow = []
+    for i, seg in enumerate(segs):
+        need = seg['demand']
+        must = [m for m in racks if left[m] < need.get(m, 0)]
+        if seg['window'] == 'start':
+            # Nothing can be refilled before the first window
+            must = []
+        rest = {m: sum(s['demand'].get(m, 0) for s in segs[i:]) for m in racks}
+        batch = [m for m in racks if m not in must and seg['window'] != 'start' and
+                 (seg['attended'] or must) and left[m] < rest[m]]
+        if must or batch:
+            refills.append((seg['window'], sorted(must + batch)))
+            for m in must + batch:
+                left[m] = cap[m]
+        for m in racks:
+            if need.get(m, 0) > left[m]:
+                overflow.append((seg['window'], m, need.get(m, 0), left[m]))
+            left[m] -= need.get(m, 0)
+    return refills, overflow
+
+
+# emptyPoints(trace, racks, start)
+# Where each mount's racks run dry without any refill: (mount, window,
+# estimated seconds into the run)
+def emptyPoints(trace, racks, start):
+    cap = {m: len(r['slots']) * (RACK_TIPS // len(ROWS) if r['multi'] else RACK_TIPS)
+           for m, r in racks.items()}
+    used = {m: _startIndex(start.get(m, 'A1'), racks[m]['multi']) for m in racks}
+    window = 'start'
+    clock = 0.0
+    out = {}
+    for cmd, t in durations(trace):
+        parts = cmd.message.split() if cmd.kind == 'comment' else []
+        if parts[:1] == ['@window']:
+            window = parts[1]
+        elif cmd.kind == 'pick_up_tip':
+            m = _mount(cmd.pipette)
+            used[m] += 1
+            if used[m] > cap[m] and m not in out:
+                out[m] = (window, clock)
+        clock += t
+    return out
+
+
+# protocolTables(path)
+# (tipWindows, tipDemand) as written in the protocol file at path, None
+# for a table the file doesn't set
+def protocolTables(path):
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    found = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                isinstance(node.targets[0], ast.Name) and \
+                node.targets[0].id in ('tipWindows', 'tipDemand'):
+            found[node.targets[0].id] = ast.literal_eval(node.value)
+    return found.get('tipWindows'), found.get('tipDemand')
+
+
+# staleTables(segs, path)
+# Differences between the tables the plan needs and the ones in the
+# protocol file at path, as printable lines
+def staleTables(segs, path):
+    windows, demand = protocolTables(path)
+    planned = [s for s in segs if s['window'] != 'start']
+    out = []
+    if windows != [s['window'] for s in planned]:
+        out.append('tipWindows is %r, the plan has %r' % (windows, [s['window'] for s in planned]))
+    demand = demand or {}
+    for s in planned:
+        need = {m: n for m, n in s['demand'].items() if n}
+        have = {m: n for m, n in demand.get(s['window'], {}).items() if n}
+        if need != have:
+            out.append('tipDemand[%r] is %r, the plan has %r' % (
+                s['window'], dict(sorted(have.items())), dict(sorted(need.items()))))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Plan tip rack refills into the idle windows of a protocol')
+    parser.add_argument('protocol', help='protocol .py file, or a saved .jsonl trace')
+    parser.add_argument('--start', nargs='*', default=[],
+                        help='first fresh tip per mount, e.g. left=C4 right=A8')
+    parser.add_argument('--check', action='store_true',
+                        help='compare tipWindows / tipDemand in the protocol with the plan')
+    args = parser.parse_args()
+    if args.check and args.protocol.endswith('.jsonl'):
+        parser.error('--check needs the protocol .py file')
+
+    if args.protocol.endswith('.jsonl'):
+        trace = loadTrace(args.protocol)
+    else:
+        trace, _ = cachedTrace(args.protocol)
+    start = dict(s.split('=') for s in args.start)
+
+    segs, racks = segments(trace)
+    if args.check:
+        stale = staleTables(segs, args.protocol)
+        for line in stale:
+            print('STALE: ' + line)
+        if not stale:
+            print('tipWindows / tipDemand match the plan')
+        sys.exit(1 if stale else 0)
+
+    print('    tipWindows = %r' % [s['window'] for s in segs if s['window'] != 'start'])
+    print('    tipDemand = {')
+    for s in segs:
+        if s['window'] != 'start':
+            print('        %r: %r,' % (s['window'], dict(sorted(s['demand'].items()))))
+    print('    }')
+
+    empties = emptyPoints(trace, racks, start)
+    for m in sorted(racks):
+        slots = ', '.join(sorted(racks[m]['slots']))
+        if m in empties:
+            print('%s racks (slot %s) run dry in window %s, %.0f s into the run' % (
+                m, slots, empties[m][0], empties[m][1]))
+        else:
+            print('%s racks (slot %s) last the whole run' % (m, slots))
+
+    refills, overflow = schedule(segs, racks, start)
+    for window, mounts in refills:
+        print('Refill at %s: %s' % (window, ', '.join(mounts)))
+    for window, m, need, left in overflow:
+        print('WARNING: %s needs %d pick-ups after window %s but full racks hold %d, add an idle window' % (
+            m, need, window, left))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import os
+import subprocess
+import tempfile
+
+from cmdtrace import deckTop, leaves, moveCost
+from simcache import cachedTrace
+from timing import durations
+
+# Command trace diff for protocol variants
+# Simulates two protocols (or one protocol at two git revisions), aligns
+# their leaf commands with a linear-space Myers diff and prints what the
+# change costs per phase: commands, tips, aspirations, travel and time.
+# Phases are the stretches between operator pauses.
+#
+#   python tracediff.py ../10TP-Quench-C3993.py ../10TP-Quench-C3993-Eco.py
+#   python tracediff.py ../10TP-Quench-C3993.py --rev-a HEAD~3 --rev-b HEAD
+
+# GLOBAL VARIABLE DEFINITION
+
+METRICS = ['commands', 'tips', 'aspirations', 'travel_mm', 'time_s']
+
+
+# signature(cmd)
+# What has to be equal for two commands to count as the same step
+def signature(cmd):
+    return (cmd.kind, cmd.pipette, cmd.labware, cmd.slot, cmd.well,
+            round(cmd.volume, 2), round(cmd.seconds, 2), cmd.message)
+
+
+# _middleSnake(a, alo, ahi, b, blo, bhi)
+# Myers' middle snake of a[alo:ahi] against b[blo:bhi]. Returns
+# (d, x, y, u, v): the edit distance and the snake from (x, y) to (u, v),
+# in absolute indices
+def _middleSnake(a, alo, ahi, b, blo, bhi):
+    n, m = ahi - alo, bhi - blo
+    delta = n - m
+    odd = delta % 2 != 0
+    dMax = (n + m + 1) // 2
+    off = dMax + 1
+    vf = [0] * (2 * off + 1)
+    vb = [0] * (2 * off + 1)
+    for d in range(dMax + 1):
+        # Forward paths
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+                x = vf[off + k + 1]
+            else:
+                x = vf[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[off + k] = x
+            kb = delta - k
+            if odd and -(d - 1) <= kb <= d - 1 and x + vb[off + kb] >= n:
+                return 2 * d - 1, alo + x0, blo + y0, alo + x, blo + y
+        # Backward paths, in reversed coordinates
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+                x = vb[off + k + 1]
+            else:
+                x = vb[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            vb[off + k] = x
+            kf = delta - k
+            if not odd and -d <= kf <= d and x + vf[off + kf] >= n:
+                return 2 * d, ahi - x, bhi - y, ahi - x0, bhi - y0
+    raise RuntimeError('no middle snake found')
+
+
+# diffRuns(a, b)
+# Edit script turning sequence a into b as runs (op, a0, a1, b0, b1) with
+# op '=' (a[a0:a1] == b[b0:b1]), '-' (deleted from a) or '+' (inserted from
+# b). Memory stays linear in len(a) + len(b)
+def diffRuns(a, b):
+    runs = []
+
+    def emit(op, a0, a1, b0, b1):
+        if a0 == a1 and b0 == b1:
+            return
+        if runs and runs[-1][0] == op and runs[-1][2] == a0 and runs[-1][4] == b0:
+            runs[-1] = (op, runs[-1][1], a1, runs[-1][3], b1)
+        else:
+            runs.append((op, a0, a1, b0, b1))
+
+    # Explicit stack of sub-problems keeps long traces clear of the
+    # recursion limit; ('=', ...) entries are matched snakes to emit
+    stack = [(None, 0, len(a), 0, len(b))]
+    while stack:
+        op, alo, ahi, blo, bhi = stack.pop()
+        if op is not None:
+            emit(op, alo, ahi, blo, bhi)
+            continue
+        # Common prefix and suffix
+        p = 0
+        while alo + p < ahi and blo + p < bhi and a[alo + p] == b[blo + p]:
+            p += 1
+        s = 0
+        while ahi - s > alo + p and bhi - s > blo + p and a[ahi - 1 - s] == b[bhi - 1 - s]:
+            s += 1
+        tail = ('=', ahi - s, ahi, bhi - s, bhi)
+        head = ('=', alo, alo + p, blo, blo + p)
+        alo, blo, ahi, bhi = alo + p, blo + p, ahi - s, bhi - s
+
+        if alo == ahi or blo == bhi:
+            stack.append(tail)
+            stack.append(('+', ahi, ahi, blo, bhi))
+            stack.append(('-', alo, ahi, blo, blo))
+            stack.append(head)
+            continue
+        d, x, y, u, v = _middleSnake(a, alo, ahi, b, blo, bhi)
+        stack.append(tail)
+        if d <= 1:
+            # One insertion or deletion around the snake
+            stack.append(('=', x, u, y, v))
+            if ahi - alo > bhi - blo:
+                stack.append(('-', alo, x, blo, blo) if x > alo else ('-', u, ahi, v, v))
+            else:
+                stack.append(('+', alo, alo, blo, y) if y > blo else ('+', u, u, v, bhi))
+        else:
+            stack.append((None, u, ahi, v, bhi))
+            stack.append(('=', x, u, y, v))
+            stack.append((None, alo, x, blo, y))
+        stack.append(head)
+    return runs
+
+
+# phaseStats(trace)
+# Metrics of every phase of trace, phases split at operator pauses
+def phaseStats(trace):
+    top = deckTop(trace)
+    phases = [dict(name='start', **dict.fromkeys(METRICS, 0))]
+    prev = None
+    for cmd, t in durations(trace):
+        if cmd.kind == 'pause':
+            phases.append(dict(name=cmd.message[:40], **dict.fromkeys(METRICS, 0)))
+        cur = phases[-1]
+        cur['commands'] += 1
+        cur['time_s'] += t
+        if cmd.kind == 'pick_up_tip':
+            cur['tips'] += 1
+        elif cmd.kind == 'aspirate':
+            cur['aspirations'] += 1
+        if cmd.point() is not None:
+            if prev is not None:
+                xy, z = moveCost(prev, cmd, top)
+                cur['travel_mm'] += xy + z
+            prev = cmd
+    return phases
+
+
+# gitVersion(path, rev)
+# Copy of path as of git revision rev in a temporary file
+def gitVersion(path, rev):
+    path = os.path.abspath(path)
+    repo = subprocess.check_output(
+        ['git', 'rev-parse', '--show-toplevel'], cwd=os.path.dirname(path), text=True).strip()
+    rel = os.path.relpath(path, repo).replace(os.sep, '/')
+    source = subprocess.check_output(['git', 'show', '%s:%s' % (rev, rel)], cwd=repo, text=True)
+    fd, tmp = tempfile.mkstemp(suffix='.py', prefix='%s-' % rev.replace('/', '_'))
+    with os.fdopen(fd, 'w') as f:
+        f.write(source)
+    return tmp
+
+
+def printPhases(phasesA, phasesB):
+    print('%-42s %-12s %10s %10s %10s' % ('phase', 'metric', 'A', 'B', 'B - A'))
+    for i in range(max(len(phasesA), len(phasesB))):
+        pa = phasesA[i] if i < len(phasesA) else None
+        pb = phasesB[i] if i < len(phasesB) else None
+        name = '%d %s' % (i, (pa or pb)['name'])
+        for metric in METRICS:
+            va = pa[metric] if pa else 0
+            vb = pb[metric] if pb else 0
+            if va == vb == 0:
+                continue
+            print('%-42s %-12s %10.1f %10.1f %+10.1f' % (name, metric, va, vb, vb - va))
+            name = ''
+
+
+def printHunks(runs, a, b, limit):
+    shown = 0
+    for op, a0, a1, b0, b1 in runs:
+        if op == '=':
+            continue
+        if shown == limit:
+            print('... more differences not shown')
+            break
+        shown += 1
+        cmds = a[a0:a1] if op == '-' else b[b0:b1]
+        start = a0 if op == '-' else b0
+        print('%s %d command(s) at %s %d' % (op, len(cmds), 'A' if op == '-' else 'B', start))
+        for cmd in cmds[:5]:
+            print('    %s %s' % (op, cmd.text))
+        if len(cmds) > 5:
+            print('    %s ...' % op)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the command traces of two protocol variants')
+    parser.add_argument('protocol', help='protocol .py file (A)')
+    parser.add_argument('other', nargs='?', help='protocol .py file (B)')
+    parser.add_argument('--rev-a', help='use protocol as of this git revision for A')
+    parser.add_argument('--rev-b', help='use protocol as of this git revision for B')
+    parser.add_argument('--hunks', type=int, default=10, help='differences to list')
+    args = parser.parse_args()
+
+    pathA = args.protocol
+    pathB = args.other or args.protocol
+    tmps = []
+    if args.rev_a:
+        pathA = gitVersion(pathA, args.rev_a)
+        tmps.append(pathA)
+    if args.rev_b:
+        pathB = gitVersion(pathB, args.rev_b)
+        tmps.append(pathB)
+    try:
+        traceA, _ = cachedTrace(pathA)
+        traceB, _ = cachedTrace(pathB)
+    finally:
+        for tmp in tmps:
+            os.remove(tmp)
+
+    a, b = leaves(traceA), leaves(traceB)
+    runs = diffRuns([signature(c) for c in a], [signature(c) for c in b])
+    same = sum(r[2] - r[1] for r in runs if r[0] == '=')
+    print('A: %d commands, B: %d commands, %d aligned, %d removed, %d added' % (
+        len(a), len(b), same, len(a) - same, len(b) - same))
+    printPhases(phaseStats(traceA), phaseStats(traceB))
+    printHunks(runs, a, b, args.hunks)
+
+
+if __name__ == '__main__':
+    main()
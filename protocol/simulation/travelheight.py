@@ -0,0 +1,141 @@
+import argparse
+
+from cmdtrace import LW_Z_MARGIN, deckTop, leaves, loadTrace, waypoint
+from simcache import cachedTrace
+
+# Per-labware-pair travel height report
+# The OT-2 planner arcs every move between two labware over the tallest
+# labware on the deck. This report works out, for each source -> destination
+# labware pair of a simulated run, the lowest safe travel height: the two
+# labware and the occupied slots the pipette passes over, plus the same
+# margin. It prints the height per pair and the Z travel hop() in the
+# protocols saves over the whole run. Only moves hop() takes over, the ones
+# with travel height waypoints in the trace, count as saved; --all lists
+# every labware pair as if all of them were hopped.
+#
+# Only labware the run touches is seen in the trace. Pass the height of
+# anything else on the deck, e.g. a module or an untouched plate:
+#
+#   python travelheight.py ../10TP-Quench-C3993.py --deck 5=60
+
+# GLOBAL VARIABLE DEFINITION
+
+# Front-left corner of each OT-2 deck slot, in mm
+SLOT_ORIGIN = {
+    '1': (0.0, 0.0), '2': (132.5, 0.0), '3': (265.0, 0.0),
+    '4': (0.0, 90.5), '5': (132.5, 90.5), '6': (265.0, 90.5),
+    '7': (0.0, 181.0), '8': (132.5, 181.0), '9': (265.0, 181.0),
+    '10': (0.0, 271.5), '11': (132.5, 271.5), '12': (265.0, 271.5),
+}
+SLOT_SIZE = (127.76, 85.48)  # mm, slot footprint
+HOP_STEP = 10.0              # mm between checks of a swept slot footprint
+
+
+# slotTops(trace, extra)
+# Highest labware in every slot the trace touches, with extra overriding
+def slotTops(trace, extra=None):
+    tops = {}
+    for cmd in trace:
+        if cmd.slot in SLOT_ORIGIN:
+            tops[cmd.slot] = max(tops.get(cmd.slot, 0.0), cmd.lwTop)
+    tops.update(extra or {})
+    return tops
+
+
+# pairZ(slotA, slotB, tops)
+# Travel height from slot A to slot B: the footprint of slot A swept over
+# to slot B, checked against every occupied slot. Mirrors pairZ() in the
+# protocols
+def pairZ(slotA, slotB, tops):
+    ax, ay = SLOT_ORIGIN[slotA]
+    bx, by = SLOT_ORIGIN[slotB]
+    steps = int(max(abs(bx - ax), abs(by - ay)) / HOP_STEP) + 1
+    z = max(tops.get(slotA, 0.0), tops.get(slotB, 0.0))
+    for slot, top in tops.items():
+        x0, y0 = SLOT_ORIGIN[slot]
+        x1, y1 = x0 + SLOT_SIZE[0], y0 + SLOT_SIZE[1]
+        for i in range(steps + 1):
+            x = ax + (bx - ax) * i / steps
+            y = ay + (by - ay) * i / steps
+            if x < x1 and x + SLOT_SIZE[0] > x0 and y < y1 and y + SLOT_SIZE[1] > y0:
+                z = max(z, top)
+                break
+    return z + LW_Z_MARGIN
+
+
+# moves(trace)
+# Every move of a pipette from one labware to another as
+# (pipette, cmd from, cmd to, hopped). Hop waypoints above their labware
+# are dropped, hopped tells whether the move went through them
+def moves(trace):
+    last = {}
+    hopped = {}
+    out = []
+    for cmd in leaves(trace):
+        if cmd.point() is None or cmd.slot not in SLOT_ORIGIN:
+            continue
+        if waypoint(cmd):
+            hopped[cmd.pipette] = True
+            continue
+        prev = last.get(cmd.pipette)
+        if prev is not None and prev.place() != cmd.place():
+            out.append((cmd.pipette, prev, cmd, hopped.get(cmd.pipette, False)))
+        last[cmd.pipette] = cmd
+        hopped[cmd.pipette] = False
+    return out
+
+
+# travelReport(trace, extra, every)
+# Per labware pair: number of moves, default and pair travel height and
+# the Z travel saved in mm, keyed by ((slot, labware), (slot, labware)).
+# Only hopped moves unless every
+def travelReport(trace, extra=None, every=False):
+    tops = slotTops(trace, extra)
+    top = max([deckTop(trace)] + list(tops.values()))
+    report = {}
+    for pipette, a, b, hopped in moves(trace):
+        if not (hopped or every):
+            continue
+        key = (a.place(), b.place())
+        if key not in report:
+            report[key] = {'moves': 0, 'default_z': top + LW_Z_MARGIN,
+                           'pair_z': pairZ(a.slot, b.slot, tops), 'saved_mm': 0.0}
+        rep = report[key]
+        rep['moves'] += 1
+        # Up out of a and down into b, both at the lower height
+        rep['saved_mm'] += 2 * max(rep['default_z'] - rep['pair_z'], 0.0)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report per labware pair travel heights and the Z travel they save')
+    parser.add_argument('protocol', help='protocol .py file, or a saved .jsonl trace')
+    parser.add_argument('--deck', nargs='*', default=[],
+                        help='height in mm of labware the run does not touch, e.g. 5=60')
+    parser.add_argument('--all', action='store_true',
+                        help='every labware pair, as if hop() were used for all moves')
+    args = parser.parse_args()
+
+    if args.protocol.endswith('.jsonl'):
+        trace = loadTrace(args.protocol)
+    else:
+        trace, _ = cachedTrace(args.protocol)
+    extra = {}
+    for item in args.deck:
+        slot, height = item.split('=')
+        extra[slot] = float(height)
+
+    report = travelReport(trace, extra, args.all)
+    print('%-34s %-34s %5s %9s %9s %9s' % ('from', 'to', 'moves', 'default', 'pair', 'saved mm'))
+    for (a, b), rep in sorted(report.items(), key=lambda kv: -kv[1]['saved_mm']):
+        print('%-34s %-34s %5d %9.1f %9.1f %9.1f' % (
+            ('%s %s' % a)[:34], ('%s %s' % b)[:34], rep['moves'],
+            rep['default_z'], rep['pair_z'], rep['saved_mm']))
+    print('Z travel saved over the run%s: %.0f mm' % (
+        ' if every move were hopped' if args.all else '',
+        sum(r['saved_mm'] for r in report.values())))
+
+
+if __name__ == '__main__':
+    main()
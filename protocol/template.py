@@ -1,3 +1,4 @@
+import math
 from multiprocessing.sharedctypes import Value
 from opentrons import protocol_api
 # metadata
@@ -12,6 +13,9 @@ TO_TRASH = 'trash'
 TO_RACK = 'rack'
 TO_DEF = 'default'
 
+# For liquid level tracking
+IMMERSION = 2.0  # mm below the liquid surface to aspirate at
+
 
 def run(protocol: protocol_api.ProtocolContext):
 
@@ -21,6 +25,11 @@ def run(protocol: protocol_api.ProtocolContext):
     defaultTipDiscardDest = TO_TRASH    # Default to discard used tips into tray 12 trash bin
     #defaultTipDiscardDest = TO_RACK    # Default to return used tips back into specified rack
 
+    # Starting volumes in uL, for liquid level tracking
+    diluentVol = 20000  # trough well 12
+    substrateVol = 5000 # trough wells 1-4, each
+    lysateVol = 50      # each lysate well in slot 5
+
 
     # ----------------  END OF RUN VARAIBLES    ----------------
     # ----------------  EQUIPMENT AND LABWARES  ----------------
@@ -81,7 +90,58 @@ def run(protocol: protocol_api.ProtocolContext):
                   ', fallback by using default discard method')
             defaultTipDisc(p, destRack)
 
+    # Per-well volume ledger in uL, seeded from the starting volumes above
+    # and updated on every aspirate and dispense below
+    wellVol = {}
+    underflow = set()   # wells whose ledger ran below zero, warned once
+
+    # wellArea(well)
+    # Cross-section of well in mm^2. Tubes count as a cylinder of their top
+    # diameter, which puts the computed level at or below the real one in a
+    # conical bottom, so the tip never ends up above the liquid
+    def wellArea(well):
+        if well.diameter:
+            return math.pi * (well.diameter / 2) ** 2
+        return well.length * well.width
+
+    # wellShare(well, p)
+    # Number of channels of p drawing from or into well: all of them for a
+    # single-row reservoir, one per well otherwise
+    def wellShare(well, p):
+        if p is not None and len(well.parent.rows()) == 1:
+            return p.channels
+        return 1
+
+    # addVol(well, vol, p)
+    # Book vol uL per channel of p into well, negative vol for out of well.
+    # A well drawn below zero is reported once in the run log, the volumes
+    # the protocol moves are left as they are
+    def addVol(well, vol, p=None):
+        key = str(well)
+        wellVol[key] = wellVol.get(key, 0.0) + vol * wellShare(well, p)
+        if wellVol[key] < 0 and key not in underflow:
+            underflow.add(key)
+            protocol.comment('WARNING: volume ledger of %s is below zero (%.0f uL), '
+                             'check its starting volume and the volumes drawn from it' % (key, wellVol[key]))
+
+    # levelAsp(well, vol, minZ, p)
+    # Location to aspirate vol uL per channel of p from well: IMMERSION mm
+    # below the level left afterwards, no lower than minZ above the bottom.
+    # Wells without a ledger entry keep the fixed minZ height
+    def levelAsp(well, vol, minZ=1.0, p=None):
+        key = str(well)
+        if key not in wellVol:
+            return well.bottom(minZ)
+        left = wellVol[key] - vol * wellShare(well, p)
+        z = min(left / wellArea(well) - IMMERSION, well.depth - IMMERSION)
+        return well.bottom(max(minZ, z))
 
+    # Seed the liquid level ledger
+    addVol(trough.wells()[11], diluentVol)
+    for k in range(4):
+        addVol(trough.wells()[k], substrateVol)
+    for well in plate_96_2.wells():
+        addVol(well, lysateVol)
 
     # ----------------  END OF HELPER FUNCTIONS ----------------
 
@@ -91,11 +151,14 @@ def run(protocol: protocol_api.ProtocolContext):
 
     left_pipette.pick_up_tip(m300rack['A1'])
     for j in range(plateCol//3):
-        left_pipette.aspirate(300, trough.wells()[11].bottom(2))
+        left_pipette.aspirate(300, levelAsp(trough.wells()[11], 300, 2, left_pipette))
+        addVol(trough.wells()[11], -300, left_pipette)
         for i in range(3):
             left_pipette.dispense(90, plate_96.wells()[i*8+j*24].bottom(4))
+            addVol(plate_96.wells()[i*8+j*24], 90)
         left_pipette.blow_out(trough.wells()[11])
-    left_tips(discard_tips, m300rack['A1'])
+        addVol(trough.wells()[11], 300 - 3 * 90, left_pipette)
+    defaultTipDisc(left_pipette, m300rack['A1'])
 
     # Dilute lysate and transfer to 384-well plate
     right_pipette.flow_rate.aspirate = 40
@@ -103,76 +166,100 @@ def run(protocol: protocol_api.ProtocolContext):
 
     for i in range(plateCol):
         right_pipette.pick_up_tip(m20rack['A'+str(i+1)])
-        right_pipette.transfer(10, plate_96_2.wells()[
-                               i*8], plate_96.wells()[i*8], mix_after=(5, 20), new_tip='never')
+        right_pipette.transfer(10, levelAsp(plate_96_2.wells()[
+                               i*8], 10), plate_96.wells()[i*8], mix_after=(5, 20), new_tip='never')
+        addVol(plate_96_2.wells()[i*8], -10)
+        addVol(plate_96.wells()[i*8], 10)
         for j in range(4):
             if i//3 % 2 < 1:
-                right_pipette.aspirate(20, plate_96.wells()[i*8])
+                right_pipette.aspirate(20, levelAsp(plate_96.wells()[i*8], 20))
+                addVol(plate_96.wells()[i*8], -20)
                 right_pipette.dispense(10, plate_384.wells()[
                                        i*16+j*96-i//3//2*48])
+                addVol(plate_384.wells()[i*16+j*96-i//3//2*48], 10)
                 right_pipette.blow_out(plate_96.wells()[i*8])
+                addVol(plate_96.wells()[i*8], 10)
             else:
-                right_pipette.aspirate(20, plate_96.wells()[i*8])
+                right_pipette.aspirate(20, levelAsp(plate_96.wells()[i*8], 20))
+                addVol(plate_96.wells()[i*8], -20)
                 right_pipette.dispense(10, plate_384.wells()[
                                        (i-3)*16+j*96+1-i//3//2*48])
+                addVol(plate_384.wells()[(i-3)*16+j*96+1-i//3//2*48], 10)
                 right_pipette.blow_out(plate_96.wells()[i*8])
-        right_tips(discard_tips, m20rack['A'+str(i+1)])
+                addVol(plate_96.wells()[i*8], 10)
+        defaultTipDisc(right_pipette, m20rack['A'+str(i+1)])
 
     protocol.pause('Add substrates!')
 
     # Add substrates
     left_pipette.pick_up_tip(m300rack['A2'])
-    left_pipette.mix(3, 300, trough.wells()[0].bottom(2))
+    left_pipette.mix(3, 300, levelAsp(trough.wells()[0], 300, 2, left_pipette))
     for i in range(int(plateCol/3)):
-        left_pipette.aspirate(170, trough.wells()[0].bottom(2))
+        left_pipette.aspirate(170, levelAsp(trough.wells()[0], 170, 2, left_pipette))
+        addVol(trough.wells()[0], -170, left_pipette)
         for j in range(3):
             if i*3//3 % 2 < 1:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+i*3//3//2*48].bottom(10))
+                addVol(plate_384.wells()[j*16+i*3//3//2*48], 50)
             else:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+1+i*3//3//2*48].bottom(10))
+                addVol(plate_384.wells()[j*16+1+i*3//3//2*48], 50)
         left_pipette.blow_out(trough.wells()[0])
-    left_tips(discard_tips, m300rack['A2'])
+        addVol(trough.wells()[0], 170 - 3 * 50, left_pipette)
+    defaultTipDisc(left_pipette, m300rack['A2'])
 
     left_pipette.pick_up_tip(m300rack['A3'])
-    left_pipette.mix(3, 300, trough.wells()[1].bottom(2))
+    left_pipette.mix(3, 300, levelAsp(trough.wells()[1], 300, 2, left_pipette))
     for i in range(int(plateCol/3)):
-        left_pipette.aspirate(170, trough.wells()[1].bottom(2))
+        left_pipette.aspirate(170, levelAsp(trough.wells()[1], 170, 2, left_pipette))
+        addVol(trough.wells()[1], -170, left_pipette)
         for j in range(3):
             if i*3//3 % 2 < 1:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+i*3//3//2*48+96].bottom(10))
+                addVol(plate_384.wells()[j*16+i*3//3//2*48+96], 50)
             else:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+1+i*3//3//2*48+96].bottom(10))
+                addVol(plate_384.wells()[j*16+1+i*3//3//2*48+96], 50)
         left_pipette.blow_out(trough.wells()[1])
-    left_tips(discard_tips, m300rack['A3'])
+        addVol(trough.wells()[1], 170 - 3 * 50, left_pipette)
+    defaultTipDisc(left_pipette, m300rack['A3'])
 
     left_pipette.pick_up_tip(m300rack['A4'])
-    left_pipette.mix(3, 300, trough.wells()[2].bottom(2))
+    left_pipette.mix(3, 300, levelAsp(trough.wells()[2], 300, 2, left_pipette))
     for i in range(int(plateCol/3)):
-        left_pipette.aspirate(170, trough.wells()[2].bottom(2))
+        left_pipette.aspirate(170, levelAsp(trough.wells()[2], 170, 2, left_pipette))
+        addVol(trough.wells()[2], -170, left_pipette)
         for j in range(3):
             if i*3//3 % 2 < 1:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+i*3//3//2*48+192].bottom(10))
+                addVol(plate_384.wells()[j*16+i*3//3//2*48+192], 50)
             else:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+1+i*3//3//2*48+192].bottom(10))
+                addVol(plate_384.wells()[j*16+1+i*3//3//2*48+192], 50)
         left_pipette.blow_out(trough.wells()[2])
-    left_tips(discard_tips, m300rack['A4'])
+        addVol(trough.wells()[2], 170 - 3 * 50, left_pipette)
+    defaultTipDisc(left_pipette, m300rack['A4'])
 
     left_pipette.pick_up_tip(m300rack['A5'])
-    left_pipette.mix(3, 300, trough.wells()[3].bottom(2))
+    left_pipette.mix(3, 300, levelAsp(trough.wells()[3], 300, 2, left_pipette))
     for i in range(int(plateCol/3)):
-        left_pipette.aspirate(170, trough.wells()[3].bottom(2))
+        left_pipette.aspirate(170, levelAsp(trough.wells()[3], 170, 2, left_pipette))
+        addVol(trough.wells()[3], -170, left_pipette)
         for j in range(3):
             if i*3//3 % 2 < 1:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+i*3//3//2*48+288].bottom(10))
+                addVol(plate_384.wells()[j*16+i*3//3//2*48+288], 50)
             else:
                 left_pipette.dispense(50, plate_384.wells()[
                                       j*16+1+i*3//3//2*48+288].bottom(10))
+                addVol(plate_384.wells()[j*16+1+i*3//3//2*48+288], 50)
         left_pipette.blow_out(trough.wells()[3])
-    left_tips(discard_tips, m300rack['A5'])
+        addVol(trough.wells()[3], 170 - 3 * 50, left_pipette)
+    defaultTipDisc(left_pipette, m300rack['A5'])